@@ -0,0 +1,67 @@
+'''
+Compare DN ordering strategies on a synthetic tree.
+
+Usage: PYTHONPATH=src python2 bench/dnsort.py [N]
+
+Times the legacy cmp-based sort (split on ',' and compare lists), the
+key-based sort_entries and the linear topo_sort_entries on N (default
+100000) entries shuffled out of order.
+'''
+import sys
+import random
+from time import time
+
+import ldapvi
+
+
+def make_tree(n):
+    entries = [('o=tuna', {}), ('ou=people,o=tuna', {}),
+               ('ou=hosts,o=tuna', {})]
+    i = 0
+    while len(entries) < n:
+        host = 'cn=host%d,ou=hosts,o=tuna' % i
+        entries.append(('uid=user%d,ou=people,o=tuna' % i, {}))
+        entries.append((host, {}))
+        entries.append(('ou=groups,' + host, {}))
+        entries.append(('cn=users,ou=groups,' + host, {}))
+        entries.append(('cn=tuna-sudo,ou=groups,' + host, {}))
+        i += 1
+    entries = entries[:n]
+    random.seed(0)
+    random.shuffle(entries)
+    return entries
+
+
+def legacy_sort(entries):
+    memo = {}
+
+    def split_dn(dn):
+        if dn not in memo:
+            li = dn.split(',')
+            li.reverse()
+            memo[dn] = li
+        return memo[dn]
+
+    entries.sort(lambda a, b: cmp(split_dn(a[0]), split_dn(b[0])))
+    return entries
+
+
+def timeit(name, f, entries):
+    entries = list(entries)
+    ldapvi.dn_key.clear()
+    t = time()
+    f(entries)
+    print('%-20s %8.3fs' % (name, time() - t))
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    entries = make_tree(n)
+    print('%d entries' % n)
+    timeit('legacy cmp sort', legacy_sort, entries)
+    timeit('sort_entries', ldapvi.sort_entries, entries)
+    timeit('topo_sort_entries', ldapvi.topo_sort_entries, entries)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,409 @@
+'''
+An in-process stand-in for LDAPObject, and synthetic trees to serve.
+
+FakeLDAPObject keeps a directory in memory and answers the subset of the
+python-ldap API that ldapvi uses: asynchronous searches with the Simple
+Paged Results control, add/modify/delete/rename, result3 and a few
+synchronous helpers. Every request takes a configurable round-trip latency
+to answer, and requests in flight overlap, like with a real server.
+
+make_tree builds entries shaped like the units in templates/: people with
+their contacts, hosts with groups of members, and domains aliasing hosts.
+'''
+import re
+import random
+from time import time, sleep
+
+import ldap
+from ldap.controls import SimplePagedResultsControl
+
+def _key(dn):
+    return ','.join(rdn.strip() for rdn in dn.lower().split(','))
+
+
+def _parent(key):
+    return key.split(',', 1)[1] if ',' in key else ''
+
+
+def _values(entry, attr):
+    attr = attr.lower()
+    for k, values in entry.iteritems():
+        if k.lower() == attr:
+            return values
+    return []
+
+
+def _compile_filter(filterstr):
+    '''
+    Compile an RFC 4515 filter string into a predicate on entries.
+    Supports &, |, !, presence, equality with * wildcards, >= and <=,
+    compared case-insensitively.
+    '''
+    if not filterstr.startswith('('):
+        filterstr = '(%s)' % filterstr
+    pred, i = _parse_filter(filterstr, 0)
+    return pred
+
+
+def _parse_filter(s, i):
+    assert s[i] == '('
+    i += 1
+    if s[i] in '&|!':
+        op = s[i]
+        i += 1
+        preds = []
+        while s[i] == '(':
+            pred, i = _parse_filter(s, i)
+            preds.append(pred)
+        i += 1
+        if op == '&':
+            return (lambda e: all(p(e) for p in preds)), i
+        elif op == '|':
+            return (lambda e: any(p(e) for p in preds)), i
+        return (lambda e: not preds[0](e)), i
+    j = s.index(')', i)
+    attr, op, value = re.match(r'([^=<>~]+)([<>~]?=)(.*)\Z', s[i:j]).groups()
+    value = value.lower()
+    if op == '=' and value == '*':
+        pred = lambda e: bool(_values(e, attr))
+    elif op == '=' and '*' in value:
+        regexp = re.compile('.*'.join(re.escape(v) for v in value.split('*'))
+                            + r'\Z')
+        pred = lambda e: any(regexp.match(v.lower()) for v in _values(e, attr))
+    elif op == '>=':
+        pred = lambda e: any(v.lower() >= value for v in _values(e, attr))
+    elif op == '<=':
+        pred = lambda e: any(v.lower() <= value for v in _values(e, attr))
+    else:
+        pred = lambda e: any(v.lower() == value for v in _values(e, attr))
+    return pred, j + 1
+
+
+class FakeLDAPObject(object):
+    '''
+    Serve entries, an iterable of (dn, entry) tuples, with every request
+    taking latency seconds to answer.
+    '''
+    def __init__(self, entries=(), latency=0.0):
+        self.latency = latency
+        self.dns = {}
+        self.entries = {}
+        self.children = {}
+        self.stamps = {}
+        self.clock = 0
+        self.msgid = 0
+        self.pending = {}
+        self.cursors = {}
+        self.requests = 0
+        for dn, entry in entries:
+            self._store(dn, dict((k, list(v)) for k, v in entry.items()))
+
+    def _stamp(self):
+        self.clock += 1
+        return '2016%010dZ' % self.clock
+
+    def _store(self, dn, entry):
+        key = _key(dn)
+        self.dns[key] = dn
+        self.entries[key] = entry
+        self.stamps[key] = self._stamp()
+        self.children.setdefault(_parent(key), set()).add(key)
+
+    def _remove(self, key):
+        del self.dns[key], self.entries[key], self.stamps[key]
+        self.children[_parent(key)].discard(key)
+
+    def _submit(self, func, *args):
+        '''
+        Run func now, and make its outcome available to result3 once the
+        latency has passed.
+        '''
+        self.requests += 1
+        self.msgid += 1
+        try:
+            outcome = True, func(*args)
+        except ldap.LDAPError as e:
+            outcome = False, e
+        self.pending[self.msgid] = time() + self.latency, outcome
+        return self.msgid
+
+    def result3(self, msgid=ldap.RES_ANY, all=1, timeout=None):
+        if msgid == ldap.RES_ANY:
+            msgid = min(self.pending, key=lambda m: self.pending[m][0])
+        ready, (ok, value) = self.pending.pop(msgid)
+        delay = ready - time()
+        if delay > 0:
+            sleep(delay)
+        if not ok:
+            raise value
+        rtype, rdata, rctrls = value
+        return rtype, rdata, msgid, rctrls
+
+    def abandon(self, msgid):
+        self.pending.pop(msgid, None)
+
+    # Searching
+
+    def _scope(self, key, scope):
+        if scope == ldap.SCOPE_BASE:
+            return [key]
+        found = []
+        todo = [key]
+        while todo:
+            k = todo.pop()
+            kids = sorted(self.children.get(k, ()))
+            found.extend(kids)
+            if scope == ldap.SCOPE_SUBTREE:
+                todo.extend(reversed(kids))
+        if scope == ldap.SCOPE_SUBTREE:
+            found.insert(0, key)
+        return found
+
+    def _project(self, key, attrlist, attrsonly):
+        entry = self.entries[key]
+        attrlist = [a.lower() for a in attrlist or ['*']]
+        if '1.1' in attrlist:
+            result = {}
+        elif '*' in attrlist:
+            result = dict((k, list(v)) for k, v in entry.iteritems())
+        else:
+            result = dict((k, list(v)) for k, v in entry.iteritems()
+                          if k.lower() in attrlist)
+        if '+' in attrlist or 'modifytimestamp' in attrlist:
+            result['modifyTimestamp'] = [self.stamps[key]]
+        if attrsonly:
+            result = dict((k, []) for k in result)
+        return self.dns[key], result
+
+    def _search(self, base, scope, filterstr, attrlist, attrsonly,
+                serverctrls):
+        paged = [c for c in serverctrls or ()
+                 if c.controlType == SimplePagedResultsControl.controlType]
+        if paged and paged[0].cookie:
+            # Continue a paged search where the last page left off
+            cursor, start = map(int, paged[0].cookie.split(':'))
+            keys = self.cursors.pop(cursor)
+        else:
+            key = _key(base)
+            if key not in self.entries and key:
+                raise ldap.NO_SUCH_OBJECT({'desc': 'No such object',
+                                           'matched': ''})
+            pred = _compile_filter(filterstr or '(objectClass=*)')
+            # modifyTimestamp is operational, but can be filtered on
+            keys = [k for k in self._scope(key, scope)
+                    if k in self.entries and pred(dict(
+                        self.entries[k], modifyTimestamp=[self.stamps[k]]))]
+            cursor, start = self.msgid, 0
+        rctrls = []
+        end = len(keys)
+        if paged:
+            cookie = ''
+            if paged[0].size and start + paged[0].size < len(keys):
+                end = start + paged[0].size
+                self.cursors[cursor] = keys
+                cookie = '%d:%d' % (cursor, end)
+            rctrls.append(SimplePagedResultsControl(False, 0, cookie))
+        return (ldap.RES_SEARCH_RESULT,
+                [self._project(k, attrlist, attrsonly)
+                 for k in keys[start:end] if k in self.entries],
+                rctrls)
+
+    def search_ext(self, base, scope, filterstr='(objectClass=*)',
+                   attrlist=None, attrsonly=0, serverctrls=None,
+                   clientctrls=None, timeout=-1, sizelimit=0):
+        return self._submit(self._search, base, scope, filterstr, attrlist,
+                            attrsonly, serverctrls)
+
+    def search_s(self, base, scope, filterstr='(objectClass=*)',
+                 attrlist=None, attrsonly=0):
+        return self.result3(self.search_ext(base, scope, filterstr, attrlist,
+                                            attrsonly))[1]
+
+    # Writing
+
+    def _add(self, dn, modlist):
+        key = _key(dn)
+        if key in self.entries:
+            raise ldap.ALREADY_EXISTS({'desc': 'Already exists'})
+        if _parent(key) not in self.entries and _parent(key):
+            raise ldap.NO_SUCH_OBJECT({'desc': 'No such object'})
+        self._store(dn, dict((attr, list(values))
+                             for attr, values in modlist))
+        return ldap.RES_ADD, [], []
+
+    def _modify(self, dn, modlist):
+        key = _key(dn)
+        if key not in self.entries:
+            raise ldap.NO_SUCH_OBJECT({'desc': 'No such object'})
+        entry = self.entries[key]
+        for op, attr, values in modlist:
+            name = next((k for k in entry if k.lower() == attr.lower()),
+                        attr)
+            if isinstance(values, str):
+                values = [values]
+            if op == ldap.MOD_ADD:
+                entry.setdefault(name, []).extend(values)
+            elif op == ldap.MOD_REPLACE:
+                entry[name] = list(values or ())
+            elif values is None:
+                entry.pop(name, None)
+            else:
+                entry[name] = [v for v in entry.get(name, [])
+                               if v not in values]
+            if not entry.get(name, True):
+                del entry[name]
+        self.stamps[key] = self._stamp()
+        return ldap.RES_MODIFY, [], []
+
+    def _delete(self, dn):
+        key = _key(dn)
+        if key not in self.entries:
+            raise ldap.NO_SUCH_OBJECT({'desc': 'No such object'})
+        if self.children.get(key):
+            raise ldap.NOT_ALLOWED_ON_NONLEAF({'desc': 'Has children'})
+        self._remove(key)
+        return ldap.RES_DELETE, [], []
+
+    def _rename(self, dn, newrdn, newsuperior, delold):
+        key = _key(dn)
+        if key not in self.entries:
+            raise ldap.NO_SUCH_OBJECT({'desc': 'No such object'})
+        if newsuperior is None:
+            newsuperior = dn.split(',', 1)[1] if ',' in dn else ''
+        newdn = newsuperior and '%s,%s' % (newrdn, newsuperior) or newrdn
+        if _key(newdn) in self.entries:
+            raise ldap.ALREADY_EXISTS({'desc': 'Already exists'})
+        entry = self.entries[key]
+        attr, value = newrdn.split('=', 1)
+        if delold:
+            oldattr, oldvalue = dn.split(',', 1)[0].split('=', 1)
+            values = _values(entry, oldattr)
+            if oldvalue in values:
+                values.remove(oldvalue)
+        if value not in _values(entry, attr):
+            entry.setdefault(attr, []).append(value)
+        # Move the subtree along, like back-mdb does
+        subtree = self._scope(key, ldap.SCOPE_SUBTREE)[1:]
+        moved = [(self.dns[k][:-len(dn)] + newdn, self.entries[k])
+                 for k in subtree]
+        for k in reversed(subtree):
+            self._remove(k)
+        self._remove(key)
+        self._store(newdn, dict((k, v) for k, v in entry.items() if v))
+        for d, e in moved:
+            self._store(d, e)
+        return ldap.RES_MODRDN, [], []
+
+    def add_ext(self, dn, modlist, serverctrls=None, clientctrls=None):
+        return self._submit(self._add, dn, modlist)
+
+    def modify_ext(self, dn, modlist, serverctrls=None, clientctrls=None):
+        return self._submit(self._modify, dn, modlist)
+
+    def delete_ext(self, dn, serverctrls=None, clientctrls=None):
+        return self._submit(self._delete, dn)
+
+    def rename(self, dn, newrdn, newsuperior=None, delold=1,
+               serverctrls=None, clientctrls=None):
+        return self._submit(self._rename, dn, newrdn, newsuperior, delold)
+
+    # Connection
+
+    def simple_bind_s(self, who='', cred=''):
+        sleep(self.latency)
+
+    bind_s = simple_bind_s
+
+    def whoami_s(self):
+        sleep(self.latency)
+        return ''
+
+    def unbind_s(self):
+        pass
+
+
+def make_tree(n, seed=0):
+    '''
+    Return a list of about n (dn, entry) tuples, parents first, shaped like
+    the units in templates/: half of them people, a third hosts with their
+    groups and the rest domains.
+    '''
+    rng = random.Random(seed)
+    entries = [('o=tuna', {'objectClass': ['organization', 'top'],
+                           'o': ['tuna']})]
+    for ou in 'people', 'hosts', 'domains':
+        entries.append(('ou=%s,o=tuna' % ou, {
+            'objectClass': ['organizationalUnit', 'top'], 'ou': [ou]}))
+    npeople = max(n // 4, 1)
+    nhosts = max(n // 12, 1)
+    ndomains = max(n - 2 * npeople - 4 * nhosts - 4, 1)
+    people = []
+    for i in xrange(npeople):
+        uid = 'user%d' % i
+        dn = 'uid=%s,ou=people,o=tuna' % uid
+        people.append(dn)
+        entries.append((dn, {
+            'objectClass': ['tunaPerson', 'inetOrgPerson', 'posixAccount',
+                            'top'],
+            'loginShell': ['/bin/bash'], 'gidNumber': ['1500'],
+            'uid': [uid], 'homeDirectory': ['/home/' + uid],
+            'cn': ['User %d' % i], 'uidNumber': [str(10000 + i)],
+            'givenName': ['User'], 'sn': [str(i)],
+            'displayName': ['User %d' % i],
+            'mail': ['%s@tuna.tsinghua.edu.cn' % uid],
+            'tunaZhName': ['\xe7\x94\xa8\xe6\x88\xb7%d' % i],
+        }))
+        entries.append(('ou=contacts,' + dn, {
+            'objectClass': ['organizationalUnit'], 'ou': ['contacts']}))
+    for i in xrange(nhosts):
+        name = 'host%d' % i
+        dn = 'cn=%s,ou=hosts,o=tuna' % name
+        entries.append((dn, {
+            'objectClass': ['tunaDevice', 'device', 'ipHost', 'top'],
+            'cn': [name], 'ipHostNumber': ['10.%d.%d.%d' % (
+                i >> 16 & 255, i >> 8 & 255, i & 255)],
+            'l': ['Tsinghua'], 'tunaOs': ['Debian'],
+            'tunaLdapLogin': ['TRUE'], 'description': ['Host %d' % i],
+        }))
+        groups = 'ou=groups,' + dn
+        entries.append((groups, {
+            'ou': ['groups'], 'objectClass': ['organizationalUnit', 'top']}))
+        for cn, gid, k in ('users', '1500', 20), ('tuna-sudo', '1501', 3):
+            entries.append(('cn=%s,%s' % (cn, groups), {
+                'gidNumber': [gid], 'cn': [cn],
+                'objectClass': ['tunaGroup', 'top'],
+                'member': rng.sample(people, min(k, len(people))),
+            }))
+    for i in xrange(ndomains):
+        name = 'domain%d' % i
+        entries.append(('cn=%s,ou=domains,o=tuna' % name, {
+            'objectClass': ['top', 'alias', 'extensibleObject'],
+            'cn': [name], 'description': ['Domain %d' % i],
+            'aliasedObjectName': ['cn=host%d,ou=hosts,o=tuna' % (
+                rng.randrange(nhosts))],
+        }))
+    return entries
+
+
+def mutate(entries, fraction=0.01, seed=0):
+    '''
+    Return a copy of an OrderedDict of entries as returned by make_entries
+    with about fraction of the leaf entries modified, a few deleted and a
+    few new people added.
+    '''
+    rng = random.Random(seed)
+    new = entries.__class__((dn, dict((k, list(v)) for k, v in e.items()))
+                            for dn, e in entries.iteritems())
+    leaves = [dn for dn in new if dn.startswith(('uid=', 'cn=domain'))]
+    k = max(int(len(leaves) * fraction), 1)
+    for dn in rng.sample(leaves, min(k, len(leaves))):
+        new[dn]['description'] = ['changed']
+    for dn in rng.sample(leaves, min(k // 10 + 1, len(leaves))):
+        if dn.startswith('cn=domain'):
+            del new[dn]
+    for i in xrange(k // 10 + 1):
+        uid = 'new%d' % i
+        new['uid=%s,ou=people,o=tuna' % uid] = {
+            'objectClass': ['inetOrgPerson', 'top'], 'uid': [uid],
+            'cn': [uid], 'sn': [uid]}
+    return new
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+'''
+Check and time LDIFWriter line folding against the previous implementation.
+
+Usage: PYTHONPATH=src python2 bench/ldifwidth.py [N]
+
+Writes N (default 5000) synthetic person entries with long CJK, mixed and
+ASCII values through both the current LDIFWriter and a copy of the
+per-character implementation it replaced, fails if the outputs differ by a
+single byte, and prints the time each took.
+'''
+import sys
+import random
+from time import time
+from cStringIO import StringIO
+
+import ldapvi
+
+
+class LegacyLDIFWriter(ldapvi.LDIFWriter):
+    '''
+    The line folding code of LDIFWriter before the width table rewrite.
+    '''
+    def _unicode_width(self, o):
+        if o == 0xe or o == 0xf:
+            return 0
+        for num, wid in self._unicode_widths:
+            if o <= num:
+                return wid
+        return 1
+
+    def _count_width(self, line):
+        w = 0
+        for c in line:
+            w += self._unicode_width(ord(c))
+        return w
+
+    def _unfoldLDIFLine(self, line):
+        first = True
+        line = line.decode('utf-8')
+        sum_width = 0
+        s = u''
+        all_width = self._count_width(line)
+        if all_width <= self._cols:
+            self._output_file.write(line.encode('utf-8'))
+            self._output_file.write(self.line_sep)
+            return
+        for c in line:
+            wid = self._unicode_width(ord(c))
+            minus = 0
+            if not first:
+                minus = 1
+            if sum_width + wid > self._cols - minus:
+                if not first:
+                    self._output_file.write(' ')
+                else:
+                    first = False
+                self._output_file.write(s.encode('utf-8'))
+                self._output_file.write(self.line_sep)
+                s = '' + c
+                sum_width = wid
+            else:
+                s += c
+                sum_width += wid
+        if sum_width > 0:
+            self._output_file.write(' ')
+            self._output_file.write(s.encode('utf-8'))
+            self._output_file.write(self.line_sep)
+
+
+ALPHABETS = [
+    u'abcdefghijklmnopqrstuvwxyz0123456789 .-_',
+    u'清华大学开源软件镜像站协会服务器管理员维护说明',
+    u'한국어テストｆｕｌｌｗｉｄｔｈ',
+    u'éäõ​',
+    u'\x0e\x0f\x7f',
+    u'\U0001f600\U00020000\U0001d400',
+]
+
+
+def make_entries(n):
+    random.seed(0)
+    entries = []
+    for i in xrange(n):
+        attrs = {'objectClass': ['top', 'inetOrgPerson'],
+                 'uid': ['user%d' % i], 'cn': ['User %d' % i]}
+        for attr, alphabet in zip(['description', 'title', 'street', 'l',
+                                   'postalAddress', 'sn'], ALPHABETS):
+            length = random.choice([5, 40, 75, 76, 77, 150, 400])
+            value = u''.join(random.choice(alphabet) for j in xrange(length))
+            attrs[attr] = [value.encode('utf-8')]
+        entries.append(('uid=user%d,ou=people,o=tuna' % i, attrs))
+    return entries
+
+
+def dump(cls, entries, cols):
+    out = StringIO()
+    writer = cls(out, cols=cols)
+    t = time()
+    for dn, attrs in entries:
+        writer.unparse(dn, attrs)
+    return out.getvalue(), time() - t
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    entries = make_entries(n)
+    for cols in 76, 10:
+        old, t_old = dump(LegacyLDIFWriter, entries, cols)
+        new, t_new = dump(ldapvi.LDIFWriter, entries, cols)
+        if old != new:
+            sys.exit('cols=%d: output differs from legacy writer' % cols)
+        print('cols=%-3d %d entries, %d bytes: legacy %.3fs, current %.3fs'
+              % (cols, n, len(new), t_old, t_new))
+
+
+if __name__ == '__main__':
+    main()
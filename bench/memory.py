@@ -0,0 +1,74 @@
+'''
+Compare the peak memory of holding a large subtree as dicts of lists and as
+CompactEntry.
+
+Usage: PYTHONPATH=src:bench python2 bench/memory.py [N]
+
+For each representation, a fresh process builds N (default 200000) entries
+shaped like templates/ (see fakeldap.make_tree), as Edit does: the search
+results, sorted, then the LDIF written for the editor parsed back, then
+diffed. Prints the peak RSS of each process and the time taken.
+'''
+import os
+import sys
+import resource
+import subprocess
+from time import time
+from collections import OrderedDict
+from cStringIO import StringIO
+
+import ldif
+
+import ldapvi
+import fakeldap
+
+
+class DictParser(ldif.LDIFParser):
+    # LDIFParser before CompactEntry
+    def handle(self, dn, entry):
+        self._entries[dn] = entry
+
+    def parse(self):
+        self._entries = OrderedDict()
+        ldif.LDIFParser.parse(self)
+        return self._entries
+
+
+def run(mode, n):
+    t = time()
+    # Entries arrive as dicts of lists from python-ldap
+    results = fakeldap.make_tree(n)
+    if mode == 'dict':
+        old = OrderedDict(ldapvi.sort_entries(results))
+    else:
+        old = OrderedDict(ldapvi.sort_entries(
+            list(ldapvi.compact_entries(results))))
+    del results
+    stream = StringIO()
+    ldapvi.Action().write_entries(stream, old.iteritems())
+    ldif_data = stream.getvalue()
+    del stream
+    parser = DictParser if mode == 'dict' else ldapvi.LDIFParser
+    new = parser(StringIO(ldif_data)).parse()
+    del ldif_data
+    changes = ldapvi.mkchanges(old, new)
+    assert not any(changes)
+    # ru_maxrss is in kilobytes on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print('%-8s %8.1f MiB peak RSS %7.2fs' % (mode, peak / 1024.0,
+                                              time() - t))
+
+
+def main():
+    if len(sys.argv) > 2:
+        run(sys.argv[1], int(sys.argv[2]))
+        return
+    n = sys.argv[1] if len(sys.argv) > 1 else '200000'
+    for mode in 'dict', 'compact':
+        # A process per mode, as peak RSS never goes down
+        subprocess.check_call([sys.executable, os.path.abspath(__file__),
+                               mode, n])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+'''
+Compare the legacy modifyModlist diff with mkchanges on a large group.
+
+Usage: PYTHONPATH=src python2 bench/mkchanges.py [N]
+
+Builds a group with N (default 10000) members, then diffs it against the
+same group with members reordered, and reordered with one member added and
+one removed. Prints the time taken and the number of modify operations and
+attribute values each approach would send to the server.
+'''
+import sys
+import random
+from time import time
+from collections import OrderedDict
+
+import ldap.modlist
+
+import ldapvi
+
+DN = 'cn=users,ou=groups,cn=host,ou=hosts,o=tuna'
+
+
+def make_group(members):
+    return {'objectClass': ['tunaGroup', 'top'], 'cn': ['users'],
+            'gidNumber': ['1500'], 'member': members}
+
+
+def legacy(old, new):
+    # mkchanges before set-semantics diffing
+    changes = []
+    for dn in new:
+        if old[dn] != new[dn]:
+            changes.append((dn, ldap.modlist.modifyModlist(old[dn], new[dn])))
+    return changes
+
+
+def current(old, new):
+    return ldapvi.mkchanges(old, new).modify
+
+
+def count_values(changes):
+    return sum(len(values or ()) for dn, modlist in changes
+               for op, attr, values in modlist)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    members = ['uid=user%d,ou=people,o=tuna' % i for i in xrange(n)]
+    random.seed(0)
+    shuffled = random.sample(members, n)
+    cases = [
+        ('reordered', shuffled),
+        ('reordered +1 -1', shuffled[1:] + ['uid=new,ou=people,o=tuna']),
+    ]
+    old = OrderedDict([(DN, make_group(members))])
+    for name, new_members in cases:
+        new = OrderedDict([(DN, make_group(new_members))])
+        for label, f in ('legacy', legacy), ('mkchanges', current):
+            ldapvi.dn_key.clear()
+            t = time()
+            changes = f(old, new)
+            print('%-16s %-10s %7.3fs %d modify, %d values' % (
+                name, label, time() - t, len(changes),
+                count_values(changes)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+'''
+Compare writing and parsing the LDIF of a large subtree in one process and
+in a pool of worker processes.
+
+Usage: PYTHONPATH=src:bench python2 bench/parallel.py [N [JOBS]]
+
+Builds N (default 100000) entries shaped like templates/ (see
+fakeldap.make_tree), then writes them as LDIF and parses it back with jobs=1
+and jobs=JOBS (default one per CPU). Prints the time taken by each and
+checks that the output is byte-identical, the entries equal, and that the
+parallel run did use the pool rather than falling back to this process.
+'''
+import sys
+from time import time
+from collections import OrderedDict
+from cStringIO import StringIO
+
+import ldapvi
+import fakeldap
+
+
+# Functions passed to parallel_map, and LDIF parses done in this process
+mapped = []
+parses = [0]
+
+
+def count_calls():
+    parallel_map = ldapvi.parallel_map
+    parse = ldapvi.LDIFParser.parse
+
+    def counting_map(func, *args):
+        mapped.append(func.__name__)
+        return parallel_map(func, *args)
+
+    def counting_parse(self):
+        parses[0] += 1
+        return parse(self)
+
+    ldapvi.parallel_map = counting_map
+    ldapvi.LDIFParser.parse = counting_parse
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    jobs = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    entries = OrderedDict(ldapvi.sort_entries(
+        list(ldapvi.compact_entries(fakeldap.make_tree(n))))).items()
+    count_calls()
+
+    outputs = []
+    for label, j in ('sequential', 1), ('parallel', jobs):
+        action = ldapvi.Action(jobs=j)
+        stream = StringIO()
+        fingerprints = {}
+        del mapped[:]
+        t = time()
+        action.write_entries(stream, entries, fingerprints)
+        t_write = time() - t
+        data = stream.getvalue()
+        parses[0] = 0
+        t = time()
+        parsed = ldapvi.parse_ldif(data, jobs=j)
+        t_parse = time() - t
+        print('%-10s write %6.2fs  parse %6.2fs' % (label, t_write, t_parse))
+        outputs.append((data, fingerprints, parsed))
+    if not ldapvi.pool_size(jobs, n):
+        print('too few entries or CPUs for a pool; nothing ran in parallel')
+    else:
+        assert mapped == ['_unparse_chunk', '_parse_chunk'], \
+            'pool not used: %r' % mapped
+        assert parses[0] == 0, 'pool result discarded and parsed again'
+
+    (data1, prints1, parsed1), (data2, prints2, parsed2) = outputs
+    assert data1 == data2, 'output differs'
+    assert prints1 == prints2, 'fingerprints differ'
+    assert parsed1.keys() == parsed2.keys() and parsed1 == parsed2, \
+        'parsed entries differ'
+
+
+if __name__ == '__main__':
+    main()
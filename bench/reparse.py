@@ -0,0 +1,62 @@
+'''
+Compare a full re-parse of an edited LDIF buffer with parse_ldif reusing
+the records left untouched.
+
+Usage: PYTHONPATH=src python2 bench/reparse.py [N]
+
+Writes N (default 50000) person entries the way Edit does, changes two
+lines, then reads the buffer back both ways and diffs it against the
+original entries. Prints the time taken by each and checks that both give
+the same changes.
+'''
+import sys
+from time import time
+from collections import OrderedDict
+from cStringIO import StringIO
+
+import ldapvi
+
+
+def make_people(n):
+    people = OrderedDict()
+    for i in xrange(n):
+        uid = 'user%d' % i
+        people['uid=%s,ou=people,o=tuna' % uid] = {
+            'objectClass': ['inetOrgPerson', 'posixAccount', 'top'],
+            'uid': [uid], 'cn': ['User %d' % i], 'sn': ['User'],
+            'uidNumber': [str(10000 + i)], 'gidNumber': ['100'],
+            'homeDirectory': ['/home/' + uid], 'loginShell': ['/bin/bash'],
+            'mail': ['%s@tuna.tsinghua.edu.cn' % uid],
+        }
+    return people
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    old = make_people(n)
+    action = ldapvi.Action()
+    stream = StringIO()
+    fingerprints = {}
+    action.write_entries(stream, old.iteritems(), fingerprints)
+    data = stream.getvalue()
+    data = data.replace('loginShell: /bin/bash\n', 'loginShell: /bin/zsh\n', 1)
+    data = data.replace('cn: User %d\n' % (n - 1), 'cn: Someone\n', 1)
+
+    results = []
+    for label, f in [
+            ('full', lambda: ldapvi.LDIFParser(StringIO(data)).parse()),
+            ('incremental',
+             lambda: ldapvi.parse_ldif(data, old, fingerprints))]:
+        t = time()
+        new = f()
+        t1 = time()
+        changes = ldapvi.mkchanges(old, new)
+        t2 = time()
+        print('%-12s parse %7.3fs  mkchanges %7.3fs  %d modify' % (
+            label, t1 - t, t2 - t1, len(changes.modify)))
+        results.append(changes)
+    assert results[0] == results[1]
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+'''
+Check that quick ldaptuna invocations stay quick.
+
+Usage: python2 bench/startup.py [BUDGET_MS]
+
+Runs `ldaptuna nop`, `ldaptuna -h` and `ldaptuna list -h` with a throwaway
+profile, and reports the best wall time of several runs of each, the time
+of a bare interpreter for reference, and whether python-ldap got imported.
+Exits non-zero if any command imports python-ldap or exceeds the bare
+interpreter time by more than BUDGET_MS (default 50) milliseconds. Python 2
+has no -X importtime, so the budget is on wall time.
+'''
+import os
+import sys
+import json
+import shutil
+import tempfile
+import subprocess
+from time import time
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+RUNS = 10
+
+# Runs ldaptuna, then reports whether python-ldap was imported on fd 3, so
+# that it is not mixed with the output of ldaptuna
+PROBE = '''
+import sys, os, runpy
+sys.argv = ['ldaptuna'] + sys.argv[1:]
+try:
+    runpy.run_module('ldaptuna', run_name='__main__')
+except SystemExit:
+    pass
+finally:
+    os.write(3, str(int('ldap' in sys.modules)))
+'''
+
+COMMANDS = [
+    ['nop'],
+    ['-h'],
+    ['list', '-h'],
+]
+
+
+def best_time(argv, env):
+    best = None
+    for i in xrange(RUNS):
+        r, w = os.pipe()
+        with open(os.devnull, 'w') as devnull:
+            t = time()
+            proc = subprocess.Popen(argv, env=env, stdout=devnull,
+                                    stderr=devnull,
+                                    preexec_fn=lambda: os.dup2(w, 3))
+            proc.wait()
+            elapsed = time() - t
+        os.close(w)
+        imported = os.read(r, 16)
+        os.close(r)
+        best = elapsed if best is None else min(best, elapsed)
+    return best, imported == '1'
+
+
+def main():
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else 50
+    home = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(home, '.ldaptuna'), 'w') as f:
+            json.dump({'default': 'bench', 'profiles': {'bench': {
+                'binddn': 'uid=bench,ou=people,o=tuna', 'bindpw': None}}}, f)
+        env = dict(os.environ, HOME=home, PYTHONPATH=SRC)
+        env.pop('LDAPTUNA', None)
+        base, _ = best_time([sys.executable, '-c', 'pass'], env)
+        print('%-12s %6.1fms' % ('(python)', base * 1000))
+        ok = True
+        for args in COMMANDS:
+            elapsed, imported = best_time(
+                [sys.executable, '-c', PROBE] + args, env)
+            over = (elapsed - base) * 1000
+            fine = over <= budget and not imported
+            ok = ok and fine
+            print('%-12s %6.1fms  +%.1fms%s%s' % (
+                ' '.join(args), elapsed * 1000, over,
+                imported and '  imports python-ldap' or '',
+                not fine and '  FAIL' or ''))
+    finally:
+        shutil.rmtree(home)
+    sys.exit(not ok)
+
+
+if __name__ == '__main__':
+    main()
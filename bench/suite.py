@@ -0,0 +1,153 @@
+'''
+Time the main stages of ldapvi against an in-process fake server.
+
+Usage: PYTHONPATH=src:bench python2 bench/suite.py [options]
+
+For each tree size, builds a synthetic tree (see fakeldap.make_tree) served
+by a FakeLDAPObject with the given round-trip latency, and times:
+
+    make_entries   paged search of the whole tree, sorted
+    sort_entries   sorting the shuffled entries by DN
+    write          serializing the entries as LDIF
+    parse          parsing that LDIF back
+    mkchanges      diffing against a copy with 1% of the entries changed
+    read_apply     parsing, diffing and applying that copy to the server
+
+Each stage is run --repeat times and the best time kept. Results are
+printed as JSON on stdout (or to --output), progress on stderr, so that
+successive runs can be compared.
+'''
+import gc
+import sys
+import json
+import random
+import platform
+import subprocess
+from time import time
+from argparse import ArgumentParser
+from cStringIO import StringIO
+
+import ldapvi
+import fakeldap
+
+
+def run_stage(repeat, setup, stage):
+    '''
+    Return the best time of repeat runs of stage(setup()), and the result
+    of the last run.
+    '''
+    best = None
+    for i in xrange(repeat):
+        arg = setup()
+        gc.collect()
+        t = time()
+        result = stage(arg)
+        elapsed = time() - t
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def bench_size(n, latency, repeat, pagesize):
+    tree = fakeldap.make_tree(n)
+    results = {}
+
+    def action(conn=None):
+        return ldapvi.Action(conn=conn, uri='ldap://fake', binddn='',
+                             base='o=tuna', scope='sub',
+                             filterstr='(objectClass=*)', pagesize=pagesize,
+                             assume_yes=True)
+
+    def server():
+        return fakeldap.FakeLDAPObject(tree, latency)
+
+    def make_entries(conn):
+        return action(conn).make_entries()
+    results['make_entries'], entries = run_stage(repeat, server,
+                                                 make_entries)
+
+    def shuffled():
+        items = entries.items()
+        random.Random(0).shuffle(items)
+        return items
+    results['sort_entries'], _ = run_stage(repeat, shuffled,
+                                           ldapvi.sort_entries)
+
+    def write(stream):
+        action().write_entries(stream, entries.iteritems())
+        return stream.getvalue()
+    results['write'], ldif = run_stage(repeat, StringIO, write)
+
+    def parse(stream):
+        return ldapvi.LDIFParser(stream).parse()
+    results['parse'], _ = run_stage(repeat, lambda: StringIO(ldif), parse)
+
+    stream = StringIO()
+    action().write_entries(stream, fakeldap.mutate(entries, 0.01).iteritems())
+    new_ldif = stream.getvalue()
+
+    new = ldapvi.LDIFParser(StringIO(new_ldif)).parse()
+    results['mkchanges'], changes = run_stage(
+        repeat, lambda: None, lambda _: ldapvi.mkchanges(entries, new))
+
+    def read_apply(conn):
+        action(conn).read_apply(StringIO(new_ldif), entries)
+        return conn
+    results['read_apply'], conn = run_stage(repeat, server, read_apply)
+
+    counts = {'entries': len(entries), 'add': len(changes.add),
+              'modify': len(changes.modify), 'delete': len(changes.delete),
+              'requests': conn.requests}
+    return results, counts
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       stderr=open('/dev/null', 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark ldapvi against a fake '
+                            'server')
+    parser.add_argument('-s', '--sizes', default='1000,10000',
+                        help='comma-separated tree sizes (default: '
+                        '%(default)s; try 100000,1000000 for big trees)')
+    parser.add_argument('-l', '--latency', type=float, default=0.001,
+                        help='round-trip latency in seconds (default: '
+                        '%(default)s)')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='runs per stage, the best is kept')
+    parser.add_argument('--pagesize', type=int,
+                        default=ldapvi.DEFAULT_PAGESIZE)
+    parser.add_argument('-o', '--output', help='write JSON results here')
+    args = parser.parse_args()
+
+    report = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'latency': args.latency,
+        'pagesize': args.pagesize,
+        'results': [],
+    }
+    for n in [int(s) for s in args.sizes.split(',')]:
+        # ldapvi reports what it applies on stdout; keep that for JSON
+        stdout, sys.stdout = sys.stdout, sys.stderr
+        try:
+            timings, counts = bench_size(n, args.latency, args.repeat,
+                                         args.pagesize)
+        finally:
+            sys.stdout = stdout
+        for stage, seconds in sorted(timings.items()):
+            print >>sys.stderr, '%8d %-14s %9.3fs' % (n, stage, seconds)
+        report['results'].append({'size': n, 'counts': counts,
+                                  'seconds': timings})
+
+    output = open(args.output, 'w') if args.output else sys.stdout
+    json.dump(report, output, indent=2, sort_keys=True)
+    output.write('\n')
+
+
+if __name__ == '__main__':
+    main()
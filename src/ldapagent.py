@@ -0,0 +1,386 @@
+'''
+An ssh-agent style daemon keeping bound LDAP connections alive across
+invocations of ldapvi and ldaptuna.
+
+The agent listens on a Unix socket. Clients send the bind parameters once,
+then forward LDAPObject method calls, see AgentConnection, over a
+connection of their own: connections are never shared between clients, but
+handed on to the next client with the same (uri, binddn, starttls) once a
+client is done with it. ldapvi uses a running agent
+automatically, so scripted invocations skip the TCP connect, StartTLS
+handshake and bind.
+'''
+import os
+import sys
+import errno
+import socket
+import struct
+import threading
+import cPickle as pickle
+from time import time, sleep
+from argparse import ArgumentParser
+from SocketServer import ThreadingMixIn, UnixStreamServer, \
+    BaseRequestHandler
+
+import ldap
+
+AGENT_ENV = 'LDAPVI_AGENT_SOCK'
+
+# Close connections unused for this many seconds.
+DEFAULT_IDLE = 600
+
+# LDAPObject methods that may be called through the agent.
+PROXIED = frozenset([
+    'abandon', 'add_ext', 'delete_ext', 'extop', 'extop_s', 'modify_ext',
+    'rename',
+    'result3', 'search_ext', 'search_s', 'whoami_s',
+])
+
+# Methods that refer to an operation started earlier on the same
+# connection, and thus cannot be retried on a new one.
+_CONTINUATIONS = frozenset(['abandon', 'result3'])
+
+# Methods starting an operation and returning its message ID.
+_ASYNC = frozenset(['add_ext', 'delete_ext', 'extop', 'modify_ext', 'rename',
+                    'search_ext'])
+
+# Result types that leave the operation in progress.
+_PARTIAL = frozenset([ldap.RES_SEARCH_ENTRY, ldap.RES_SEARCH_REFERENCE,
+                      ldap.RES_INTERMEDIATE])
+
+_HEADER = struct.Struct('!I')
+
+
+def default_socket():
+    return '/tmp/ldapvi-%d/agent.sock' % os.getuid()
+
+
+def agent_socket():
+    '''
+    Return the path of the agent socket, from $LDAPVI_AGENT_SOCK or the
+    default location.
+    '''
+    return os.environ.get(AGENT_ENV) or default_socket()
+
+
+def _recv_exactly(sock, n):
+    buf = []
+    while n:
+        data = sock.recv(n)
+        if not data:
+            raise EOFError
+        buf.append(data)
+        n -= len(data)
+    return ''.join(buf)
+
+
+def send_msg(sock, obj):
+    data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    sock.sendall(_HEADER.pack(len(data)) + data)
+
+
+def recv_msg(sock):
+    n, = _HEADER.unpack(_recv_exactly(sock, _HEADER.size))
+    return pickle.loads(_recv_exactly(sock, n))
+
+
+class AgentConnection(object):
+    '''
+    A stand-in for LDAPObject forwarding the methods in PROXIED to a
+    connection held by the agent.
+    '''
+    def __init__(self, path, uri, binddn, bindpw, starttls=True):
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self._sock.connect(path)
+            self._call('bind', uri, binddn, bindpw, starttls)
+        except:
+            self._sock.close()
+            raise
+
+    def _call(self, *request):
+        send_msg(self._sock, request)
+        status, value = recv_msg(self._sock)
+        if status == 'error':
+            raise value
+        return value
+
+    def __getattr__(self, name):
+        if name not in PROXIED:
+            raise AttributeError(name)
+
+        def method(*args, **kw):
+            return self._call('call', name, args, kw)
+        return method
+
+    def unbind_s(self):
+        self._sock.close()
+
+
+def connect(uri, binddn, bindpw, starttls=True, path=None):
+    '''
+    Return an AgentConnection bound as binddn on uri, or None if no agent
+    is running. LDAP errors from the agent, e.g. a failed bind, are raised.
+    '''
+    try:
+        return AgentConnection(path or agent_socket(),
+                               uri, binddn, bindpw, starttls)
+    except (socket.error, EOFError):
+        return None
+
+
+class _Slot(object):
+    '''
+    A connection held by the agent, along with what is needed to re-create
+    it and the message IDs of the operations in progress on it.
+    '''
+    def __init__(self, uri, binddn, bindpw, starttls):
+        self.key = uri, binddn, starttls
+        self.uri = uri
+        self.binddn = binddn
+        self.bindpw = bindpw
+        self.starttls = starttls
+        self.pending = set()
+        self.conn = None
+        self.reconnect()
+
+    def reconnect(self):
+        import ldapvi
+        if self.conn is not None:
+            self.close()
+        self.conn = ldapvi.connect(self.uri, self.binddn, self.bindpw,
+                                   self.starttls)
+        self.used = time()
+
+    def call(self, name, args, kw):
+        self.used = time()
+        try:
+            value = self._call(name, args, kw)
+        except (ldap.TIMEOUT, ldap.SERVER_DOWN):
+            raise
+        except ldap.LDAPError:
+            if name == 'result3' and args and args[0] != ldap.RES_ANY:
+                # The operation is over, having failed
+                self.pending.discard(args[0])
+            raise
+        if name in _ASYNC:
+            self.pending.add(value)
+        elif name == 'abandon':
+            self.pending.discard(args[0])
+        elif name == 'result3' and value[0] not in _PARTIAL:
+            self.pending.discard(value[2])
+        return value
+
+    def _call(self, name, args, kw):
+        try:
+            return getattr(self.conn, name)(*args, **kw)
+        except ldap.SERVER_DOWN:
+            if name in _CONTINUATIONS or self.pending:
+                raise
+        # The server or a firewall dropped the idle connection; make a new
+        # one and retry once.
+        self.reconnect()
+        return getattr(self.conn, name)(*args, **kw)
+
+    def close(self):
+        try:
+            self.conn.unbind_s()
+        except ldap.LDAPError:
+            pass
+        self.conn = None
+
+
+class Agent(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, idle=DEFAULT_IDLE):
+        UnixStreamServer.__init__(self, path, Handler)
+        self.idle = idle
+        # Connections no client is using, by (uri, binddn, starttls), the
+        # most recently used last
+        self.slots = {}
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+
+    def checkout(self, uri, binddn, bindpw, starttls):
+        '''
+        Return a connection for one client to use alone: an idle one bound
+        with the same password, or a new one.
+        '''
+        with self.lock:
+            idle = self.slots.get((uri, binddn, starttls), [])
+            for slot in reversed(idle):
+                # Otherwise bind anew, so that a wrong password is never
+                # accepted on the strength of an earlier bind
+                if slot.bindpw == bindpw:
+                    idle.remove(slot)
+                    return slot
+        return _Slot(uri, binddn, bindpw, starttls)
+
+    def checkin(self, slot):
+        '''
+        Take back the connection of a client done with it. It is closed
+        instead if operations the client started are still in progress,
+        whose results would reach the next client.
+        '''
+        if slot.conn is None:
+            return
+        if slot.pending:
+            slot.close()
+            return
+        slot.used = time()
+        with self.lock:
+            self.slots.setdefault(slot.key, []).append(slot)
+
+    def reap(self):
+        '''
+        Close connections idle for longer than self.idle, forever.
+        '''
+        while True:
+            sleep(min(self.idle, 60))
+            with self.lock:
+                for key, idle in self.slots.items():
+                    for slot in idle[:]:
+                        if time() - slot.used > self.idle:
+                            slot.close()
+                            idle.remove(slot)
+                    if not idle:
+                        del self.slots[key]
+
+    def verify_request(self, request, client_address):
+        # Only serve our own user
+        cred = request.getsockopt(socket.SOL_SOCKET,
+                                  getattr(socket, 'SO_PEERCRED', 17),
+                                  struct.calcsize('3i'))
+        pid, uid, gid = struct.unpack('3i', cred)
+        return uid == os.getuid()
+
+
+class Handler(BaseRequestHandler):
+    def handle(self):
+        # The connection of this client, see Agent.checkout
+        self.slot = None
+        try:
+            self.serve_client()
+        finally:
+            if self.slot is not None:
+                self.server.checkin(self.slot)
+
+    def serve_client(self):
+        while True:
+            try:
+                request = recv_msg(self.request)
+            except EOFError:
+                return
+            try:
+                if request[0] == 'bind':
+                    if self.slot is not None:
+                        self.server.checkin(self.slot)
+                        self.slot = None
+                    self.slot = self.server.checkout(*request[1:])
+                    reply = 'ok', None
+                elif request[0] == 'call' and self.slot and \
+                        request[1] in PROXIED:
+                    reply = 'ok', self.slot.call(*request[1:])
+                elif request[0] == 'shutdown':
+                    send_msg(self.request, ('ok', None))
+                    self.server.stopping.set()
+                    return
+                else:
+                    reply = 'error', ValueError('bad request %r' % (
+                        request[:2],))
+            except Exception as e:
+                reply = 'error', e
+            send_msg(self.request, reply)
+
+
+def serve(path, idle=DEFAULT_IDLE, foreground=False):
+    '''
+    Run an agent listening on path, printing shell commands to set
+    $LDAPVI_AGENT_SOCK. Unless foreground is true, detach into the
+    background.
+    '''
+    dirname = os.path.dirname(path)
+    try:
+        os.mkdir(dirname, 0700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    if os.stat(dirname).st_uid != os.getuid():
+        sys.exit('%s is not owned by you, refusing to use it' % dirname)
+    if os.path.exists(path):
+        if _alive(path):
+            sys.exit('An agent is already listening on %s' % path)
+        os.unlink(path)
+
+    old_umask = os.umask(0077)
+    agent = Agent(path, idle)
+    os.umask(old_umask)
+
+    print('%s=%s; export %s;' % (AGENT_ENV, path, AGENT_ENV))
+    sys.stdout.flush()
+    if not foreground:
+        if os.fork():
+            os._exit(0)
+        os.setsid()
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in 0, 1, 2:
+            os.dup2(devnull, fd)
+
+    for target in agent.serve_forever, agent.reap:
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+    try:
+        # Wait with a timeout, so that ^C works in the foreground
+        while not agent.stopping.wait(60):
+            pass
+        agent.shutdown()
+    finally:
+        os.unlink(path)
+
+
+def _alive(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        return True
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+
+
+def kill(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        send_msg(sock, ('shutdown',))
+        recv_msg(sock)
+    except (socket.error, EOFError):
+        sys.exit('No agent listening on %s' % path)
+    finally:
+        sock.close()
+
+
+def main():
+    parser = ArgumentParser(description='Keep bound LDAP connections alive '
+                            'for ldapvi and ldaptuna')
+    parser.add_argument('-a', '--socket', default=agent_socket(),
+                        help='bind to this socket (default: %(default)s)')
+    parser.add_argument('-t', '--idle', type=int, default=DEFAULT_IDLE,
+                        help='close connections idle for this many seconds')
+    parser.add_argument('-d', '--foreground', action='store_true',
+                        default=False, help='do not detach')
+    parser.add_argument('-k', '--kill', action='store_true', default=False,
+                        help='stop the running agent')
+    args = parser.parse_args()
+
+    if args.kill:
+        kill(args.socket)
+    else:
+        serve(args.socket, args.idle, args.foreground)
+
+
+if __name__ == '__main__':
+    main()
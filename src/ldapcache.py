@@ -0,0 +1,164 @@
+'''
+A persistent local cache of search results, refreshed incrementally.
+
+The cache for a (server, binddn, base, scope, filter) tuple remembers the
+entries found along with their modifyTimestamp. A refresh asks the server
+only for entries modified since the newest timestamp seen, plus the bare DNs
+in scope to notice deletions, instead of downloading the whole subtree. If
+the server does not let every entry's modifyTimestamp be read, every refresh
+downloads the whole subtree.
+'''
+import os
+import errno
+import hashlib
+import cPickle as pickle
+from collections import OrderedDict
+from tempfile import mkstemp
+
+import ldapvi
+
+STAMP = 'modifyTimestamp'
+
+# Bumped whenever the on-disk format changes; other versions are ignored.
+FORMAT = 2
+
+
+def cache_dir():
+    return os.path.join(os.environ.get('XDG_CACHE_HOME') or
+                        os.path.expanduser('~/.cache'), 'ldapvi')
+
+
+def _and(filterstr, assertion):
+    if not filterstr.startswith('('):
+        filterstr = '(%s)' % filterstr
+    return '(&%s%s)' % (filterstr, assertion)
+
+
+class SearchCache(object):
+    def __init__(self, uri, binddn, base, scope, filterstr):
+        self.key = uri, binddn, base, scope, filterstr
+        self.path = os.path.join(cache_dir(),
+                                 hashlib.sha1(repr(self.key)).hexdigest())
+        self.entries = OrderedDict()
+        self.stamps = {}
+        self.synced = None
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                data = pickle.load(f)
+        except Exception:
+            # Missing or corrupt cache, start over
+            return
+        if data.get('format') != FORMAT or data.get('key') != self.key:
+            return
+        self.entries = data['entries']
+        self.stamps = data['stamps']
+        # Empty if no stamps could be read, by earlier versions
+        self.synced = data['synced'] or None
+
+    def save(self):
+        dirname = os.path.dirname(self.path)
+        try:
+            os.makedirs(dirname, 0700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        # mkstemp creates the file with mode 0600; rename it into place so
+        # that readers never see a partial cache
+        fd, tmp = mkstemp(dir=dirname)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump({'format': FORMAT, 'key': self.key,
+                         'entries': self.entries, 'stamps': self.stamps,
+                         'synced': self.synced},
+                        f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, self.path)
+
+    def _search(self, conn, filterstr, attrlist, pagesize):
+        uri, binddn, base, scope, _ = self.key
+        return ldapvi.search_iter(conn, base, scope, filterstr, attrlist,
+                                  pagesize)
+
+    def _update(self, results):
+        '''
+        Store (dn, entry) results of a search for '*' and STAMP. Return
+        whether all of them had a STAMP.
+        '''
+        stamped = True
+        for dn, entry in results:
+            stamp = entry.pop(STAMP, [''])[0]
+            dn = intern(dn)
+            self.entries[dn] = ldapvi.CompactEntry(entry)
+            self.stamps[dn] = stamp
+            if stamp:
+                self.synced = max(self.synced, stamp)
+            else:
+                stamped = False
+        return stamped
+
+    def refresh(self, conn, pagesize=ldapvi.DEFAULT_PAGESIZE):
+        '''
+        Bring the cache up to date with the server, save it and return an
+        OrderedDict of its entries sorted with sort_entries.
+        '''
+        uri, binddn, base, scope, filterstr = self.key
+        attrlist = ['*', STAMP]
+        resort = True
+        if self.synced is not None:
+            # Using >= rather than > catches entries modified within the
+            # same second as the last refresh; refetching a few is harmless
+            changed = list(self._search(
+                conn, _and(filterstr, '(%s>=%s)' % (STAMP, self.synced)),
+                attrlist, pagesize))
+            present = set(dn for dn, entry in
+                          self._search(conn, filterstr, ['1.1'], pagesize))
+            known = set(self.entries)
+            known.update(dn for dn, entry in changed)
+            if present <= known:
+                for dn in known - present:
+                    self.entries.pop(dn, None)
+                    self.stamps.pop(dn, None)
+                resort = any(dn not in self.entries for dn, entry in changed)
+                if not self._update(changed):
+                    self.synced = None
+            else:
+                # Entries moved into scope without a newer timestamp; this
+                # should not happen, but be safe and start over
+                self.synced = None
+        if self.synced is None:
+            self.entries = OrderedDict()
+            self.stamps = {}
+            if not self._update(self._search(conn, filterstr, attrlist,
+                                             pagesize)):
+                # Entries without a stamp would go unnoticed when modified;
+                # search everything again next time
+                self.synced = None
+        if resort:
+            self.entries = OrderedDict(
+                ldapvi.sort_entries(self.entries.items()))
+        self.save()
+        return self.entries
+
+    def modified(self, conn, dns, pagesize=ldapvi.DEFAULT_PAGESIZE):
+        '''
+        Return those of dns whose entries have been modified on the server
+        since the last refresh. Without stamps to go by, none are.
+        '''
+        uri, binddn, base, scope, filterstr = self.key
+        if self.synced is None:
+            return []
+        dns = set(dns)
+        delta = _and(filterstr, '(%s>=%s)' % (STAMP, self.synced))
+        stale = []
+        for dn, entry in self._search(conn, delta, ['*', STAMP], pagesize):
+            if dn not in dns:
+                continue
+            stamp = entry.pop(STAMP, [''])[0]
+            # Stamps are to the second, so an entry modified again within
+            # the second of the newest stamp keeps it; compare the entry
+            # then
+            if stamp != self.stamps.get(dn) or \
+                    ldapvi.CompactEntry(entry) != self.entries.get(dn):
+                stale.append(dn)
+        return stale
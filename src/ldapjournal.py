@@ -0,0 +1,166 @@
+'''
+A journal of the operations of an apply, for resuming it after a failure.
+
+The journal starts with the changes planned, as returned by
+ldapvi.mkchanges. Each operation is then recorded before it is issued and
+once the server acknowledges it, flushed to disk before going on. A resumed
+apply skips the operations acknowledged, checks on the server whether those
+issued but never acknowledged took effect, and applies the rest; nothing
+else needs to be searched again.
+'''
+import os
+import cPickle as pickle
+
+import ldap
+
+import ldapvi
+
+# Bumped whenever the format changes; journals of other versions are
+# refused.
+FORMAT = 2
+
+
+def journal_path(fname):
+    '''
+    Return the path of the journal of applying the LDIF file fname.
+    '''
+    return os.path.splitext(fname)[0] + '.journal'
+
+
+def took_effect(conn, op, change):
+    '''
+    Tell whether an operation, as returned by ldapvi.change_ops, is in
+    effect on the server.
+    '''
+    dn = change[0]
+    if op == 'rename':
+        return not took_effect(conn, 'add', change) and \
+            took_effect(conn, 'add', (ldapvi.renamed_dn(*change),))
+    if op == 'modify':
+        attrlist = [attr for mod, attr, values in change[1]]
+    else:
+        attrlist = ['1.1']
+    try:
+        found = conn.search_s(dn, ldap.SCOPE_BASE, '(objectClass=*)',
+                              attrlist)
+    except ldap.NO_SUCH_OBJECT:
+        return op == 'delete'
+    if op != 'modify':
+        return op == 'add'
+    # Compare values as modify_modlist does
+    attrs = ldapvi._attr_values(found[0][1] if found else {})
+    mods = []
+    for mod, attr, values in change[1]:
+        key = attr.lower()
+        wanted = ldapvi._attr_values({attr: values or ()}).get(key)
+        mods.append((mod, key, wanted[1] if wanted else {}))
+    # Values deleted and added back in another spelling are equal to the
+    # server either way; only their spelling there tells
+    respelled = set.intersection(*[
+        set((key, k) for m, key, wanted in mods if m == mod for k in wanted)
+        for mod in (ldap.MOD_DELETE, ldap.MOD_ADD)])
+    for mod, key, wanted in mods:
+        there = attrs.get(key, (key, {}))[1]
+        if mod == ldap.MOD_ADD:
+            ok = all(k in there and
+                     ((key, k) not in respelled or there[k] == v)
+                     for k, v in wanted.iteritems())
+        elif mod == ldap.MOD_DELETE:
+            ok = not ([k for k in wanted
+                       if k in there and (key, k) not in respelled]
+                      if wanted else there)
+        else:
+            ok = set(wanted) == set(there) and \
+                (key not in ldapvi.RESPELLABLE or
+                 all(there[k] == v for k, v in wanted.iteritems()))
+        if not ok:
+            return False
+    return True
+
+
+class Journal(object):
+    '''
+    The journal at path. If changes are given, start it anew with them;
+    otherwise read it back to resume, raising IOError if there is none and
+    ValueError if it cannot be read. Records are appended in either case.
+    '''
+    def __init__(self, path, changes=None):
+        self.path = path
+        # (op, dn) of the operations issued and acknowledged
+        self.pending = set()
+        self.acknowledged = set()
+        if changes is not None:
+            self.changes = changes
+            self._file = open(path, 'wb')
+            # As a plain tuple, which does not depend on how ldapvi was
+            # imported
+            self._write({'format': FORMAT, 'changes': tuple(changes)})
+        else:
+            self._load()
+            self._file = open(path, 'ab')
+
+    def _load(self):
+        with open(self.path, 'rb') as f:
+            try:
+                header = pickle.load(f)
+            except Exception:
+                raise ValueError('%s is not a journal' % self.path)
+            if not isinstance(header, dict) or \
+                    header.get('format') != FORMAT:
+                raise ValueError('%s is a journal of another version' %
+                                 self.path)
+            self.changes = ldapvi.Changes(*header['changes'])
+            while True:
+                try:
+                    record, op, dn = pickle.load(f)
+                except Exception:
+                    # The end, possibly cut short by a crash
+                    break
+                if record == 'issued':
+                    self.pending.add((op, dn))
+                else:
+                    self.pending.discard((op, dn))
+                    self.acknowledged.add((op, dn))
+
+    def _write(self, record):
+        pickle.dump(record, self._file, pickle.HIGHEST_PROTOCOL)
+        self._file.flush()
+
+    def issued(self, op, change):
+        self.pending.add((op, change[0]))
+        self._write(('issued', op, change[0]))
+
+    def done(self, op, change):
+        self.pending.discard((op, change[0]))
+        self.acknowledged.add((op, change[0]))
+        self._write(('done', op, change[0]))
+
+    def settle(self, conn):
+        '''
+        Check on the server the operations issued but never acknowledged,
+        recording those that took effect as done. Return how many did.
+        '''
+        ops = dict(((op, change[0]), change)
+                   for op, change in ldapvi.change_ops(self.changes))
+        settled = 0
+        for op, dn in sorted(self.pending):
+            if took_effect(conn, op, ops[op, dn]):
+                self.done(op, ops[op, dn])
+                settled += 1
+        return settled
+
+    def remaining(self):
+        '''
+        Return the changes not acknowledged yet.
+        '''
+        return ldapvi.Changes(*[
+            [change for change in changes
+             if (op, change[0]) not in self.acknowledged]
+            for op, changes in zip(self.changes._fields, self.changes)])
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+    def remove(self):
+        os.unlink(self.path)
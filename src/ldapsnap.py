@@ -0,0 +1,280 @@
+'''
+Offline snapshots of a directory in SQLite, and searches against them.
+
+A snapshot holds every entry of a subtree along with an index of attribute
+values and of the DN hierarchy. Searches compile an RFC 4515 filter into a
+query on the index, with the scope narrowed to the base entry, its children
+or its subtree by index range, and return the same entries as the server
+would have when the snapshot was taken.
+'''
+import os
+import re
+import errno
+import sqlite3
+import hashlib
+import cPickle as pickle
+from time import time
+from tempfile import mkstemp
+
+import ldap
+
+import ldapvi
+
+# Bumped whenever the schema changes; snapshots of other versions are
+# refused.
+FORMAT = 2
+
+_SCHEMA = '''
+CREATE TABLE meta (key TEXT PRIMARY KEY, value);
+-- path is the DN key (see ldapvi.dn_key) with RDNs joined by newlines, so
+-- that a subtree is a range of paths; parent is the path of the parent
+CREATE TABLE entries (id INTEGER PRIMARY KEY, dn TEXT, path TEXT,
+                      parent TEXT, data BLOB);
+-- One row per attribute value; type is lowercased and norm normalized as
+-- for comparison, see _normalizer
+CREATE TABLE attrs (entry INTEGER, type TEXT, value TEXT, norm TEXT);
+'''
+
+# Created once the entries are in, which is faster than maintaining them
+_INDEXES = '''
+CREATE UNIQUE INDEX entries_path ON entries (path);
+CREATE INDEX entries_parent ON entries (parent);
+CREATE INDEX attrs_type_norm ON attrs (type, norm);
+CREATE INDEX attrs_entry ON attrs (entry);
+'''
+
+# Separates RDNs in paths; '\x0b' is the next character, bounding subtrees
+_SEP = '\n'
+_SEP_NEXT = '\x0b'
+
+
+class FilterError(ValueError):
+    pass
+
+
+def default_path(binddn):
+    '''
+    Return where to keep the snapshot taken as binddn, which may not see
+    the same entries as others.
+    '''
+    return os.path.join(
+        os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+        'ldapvi', 'snapshot-%s.sqlite' % hashlib.sha1(binddn).hexdigest())
+
+
+def _path(dn):
+    return _SEP.join(ldapvi.dn_key(dn))
+
+
+# Attributes matched byte for byte (octetStringMatch); those without a
+# known matching rule are taken to ignore case and spacing, like most string
+# attributes do
+_CASE_EXACT = frozenset([
+    'audio', 'cacertificate', 'certificaterevocationlist', 'jpegphoto',
+    'photo', 'sshpublickey', 'usercertificate', 'userpassword',
+    'userpkcs12', 'usersmimecertificate'])
+
+
+def _normalizer(attr):
+    '''
+    Return the function normalizing values of attr for comparison, or None
+    if they are compared as they are.
+    '''
+    if attr in _CASE_EXACT:
+        return None
+    return ldapvi.VALUE_NORMALIZERS.get(attr, ldapvi._normalize)
+
+
+def _norm(attr, value):
+    norm = _normalizer(attr)
+    if norm is None:
+        return value
+    value = norm(value)
+    # dn_key returns a tuple
+    return _SEP.join(value) if isinstance(value, tuple) else value
+
+
+def write(path, entries, **meta):
+    '''
+    Save an iterable of (dn, entry) tuples as a snapshot at path, replacing
+    any existing one only once complete. meta is saved along, e.g. the base
+    of the subtree, which searches must stay within. Return the number of
+    entries saved.
+    '''
+    dirname = os.path.dirname(path) or '.'
+    try:
+        os.makedirs(dirname, 0700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    # mkstemp creates the file with mode 0600
+    fd, tmp = mkstemp(dir=dirname, suffix='.sqlite')
+    os.close(fd)
+    try:
+        db = sqlite3.connect(tmp)
+        db.text_factory = str
+        db.executescript(_SCHEMA)
+        n = 0
+        for n, (dn, entry) in enumerate(entries, 1):
+            path_ = _path(dn)
+            db.execute('INSERT INTO entries VALUES (?, ?, ?, ?, ?)', (
+                n, dn, path_, path_.rpartition(_SEP)[0],
+                sqlite3.Binary(pickle.dumps(dict(entry),
+                                            pickle.HIGHEST_PROTOCOL))))
+            db.executemany('INSERT INTO attrs VALUES (?, ?, ?, ?)', [
+                (n, attr.lower(), v, _norm(attr.lower(), v))
+                for attr, values in entry.iteritems() for v in values])
+        db.executescript(_INDEXES)
+        meta.update(format=FORMAT, taken=time())
+        db.executemany('INSERT INTO meta VALUES (?, ?)', meta.items())
+        db.commit()
+        db.close()
+        os.rename(tmp, path)
+    except:
+        os.unlink(tmp)
+        raise
+    return n
+
+
+def _unescape(value):
+    return re.sub(r'\\([0-9a-fA-F]{2})',
+                  lambda m: chr(int(m.group(1), 16)), value)
+
+
+def _glob_escape(s):
+    return re.sub(r'([*?[])', r'[\1]', s)
+
+
+# An attribute description with options, then the operator
+_ITEM = re.compile(r'([A-Za-z0-9.-]+)(?:;[A-Za-z0-9;-]*)?(=|~=|>=|<=)')
+
+
+def _compile_item(item, params):
+    m = _ITEM.match(item)
+    if m is None:
+        raise FilterError('bad or unsupported filter item (%s)' % item)
+    attr, op = m.group(1).lower(), m.group(2)
+    value = item[m.end():]
+    if op == '=' and value == '*':
+        if attr == 'objectclass':
+            # Every entry has one
+            return '1'
+        params.append(attr)
+        return 'e.id IN (SELECT entry FROM attrs WHERE type = ?)'
+    params.append(attr)
+    if op == '=' and '*' in value:
+        pieces = [_unescape(p) for p in value.split('*')]
+        if _normalizer(attr) is ldapvi._normalize:
+            # Squeezing would also swallow spaces at the ends of pieces,
+            # so lowercase only
+            pieces = [p.lower() for p in pieces]
+            column = 'norm'
+        else:
+            column = 'value'
+        params.append('*'.join(_glob_escape(p) for p in pieces))
+        return ('e.id IN (SELECT entry FROM attrs WHERE type = ? '
+                'AND %s GLOB ?)' % column)
+    norm = _norm(attr, _unescape(value))
+    params.append(norm)
+    if op in ('=', '~='):
+        # Approximate matching is taken as equality
+        return 'e.id IN (SELECT entry FROM attrs WHERE type = ? AND norm = ?)'
+    if _normalizer(attr) is ldapvi._normalize_int:
+        compare = 'CAST(norm AS INTEGER) %s CAST(? AS INTEGER)' % op
+    else:
+        compare = 'norm %s ?' % op
+    return 'e.id IN (SELECT entry FROM attrs WHERE type = ? AND %s)' % (
+        compare)
+
+
+def _compile(s, i, params):
+    if s[i:i + 1] != '(':
+        raise FilterError('expected ( at %d in %s' % (i, s))
+    i += 1
+    op = s[i:i + 1]
+    if op in ('&', '|', '!'):
+        i += 1
+        terms = []
+        while s[i:i + 1] == '(':
+            term, i = _compile(s, i, params)
+            terms.append(term)
+        if s[i:i + 1] != ')' or op == '!' and len(terms) != 1:
+            raise FilterError('bad filter at %d in %s' % (i, s))
+        if op == '!':
+            sql = 'NOT (%s)' % terms[0]
+        elif not terms:
+            # Absolute true and false (RFC 4526)
+            sql = '1' if op == '&' else '0'
+        else:
+            sql = '(%s)' % (' AND ' if op == '&' else ' OR ').join(terms)
+        return sql, i + 1
+    end = s.find(')', i)
+    if end < 0:
+        raise FilterError('missing ) in %s' % s)
+    return _compile_item(s[i:end], params), end + 1
+
+
+def compile_filter(filterstr):
+    '''
+    Compile an RFC 4515 filter string into an SQL condition on the entries
+    row e, and its parameters. Supports &, |, !, presence, equality,
+    substrings, >= and <=; extensible matches are not supported.
+    Equality uses the matching rules of ldapvi.VALUE_NORMALIZERS, ignoring
+    case and spacing for other attributes unless known to match exactly,
+    and substrings ignore case where equality does.
+    '''
+    filterstr = filterstr.strip() or '(objectClass=*)'
+    if not filterstr.startswith('('):
+        filterstr = '(%s)' % filterstr
+    params = []
+    sql, i = _compile(filterstr, 0, params)
+    if i != len(filterstr):
+        raise FilterError('trailing garbage in %s' % filterstr)
+    return sql, params
+
+
+class Snapshot(object):
+    def __init__(self, path):
+        if not os.path.exists(path):
+            raise IOError(errno.ENOENT, 'no snapshot', path)
+        self.db = sqlite3.connect(path)
+        self.db.text_factory = str
+        self.meta = dict(self.db.execute('SELECT key, value FROM meta'))
+        if self.meta.get('format') != FORMAT:
+            raise IOError('snapshot %s is of another version, take it '
+                          'again' % path)
+
+    def search(self, base, scope, filterstr):
+        '''
+        Yield (dn, entry) tuples matching filterstr in scope of base, in the
+        order the server sent them when the snapshot was taken. Raise
+        ldap.NO_SUCH_OBJECT if the snapshot has no base entry, like the
+        server would, and ValueError if base is outside the snapshot.
+        '''
+        top = _path(self.meta['base'])
+        path = _path(base)
+        if top and not (path == top or path.startswith(top + _SEP)):
+            raise ValueError('%s is outside the snapshot of %s' % (
+                base, self.meta['base']))
+        if path and not self.db.execute(
+                'SELECT 1 FROM entries WHERE path = ?', (path,)).fetchone():
+            raise ldap.NO_SUCH_OBJECT({'desc': 'No such object',
+                                       'matched': self.meta['base']})
+
+        if scope == ldap.SCOPE_BASE:
+            where, params = 'e.path = ?', [path]
+        elif scope == ldap.SCOPE_ONELEVEL:
+            where, params = 'e.parent = ?', [path]
+        elif not path:
+            where, params = '1', []
+        else:
+            where, params = 'e.path = ? OR e.path >= ? AND e.path < ?', [
+                path, path + _SEP, path + _SEP_NEXT]
+        cond, cond_params = compile_filter(filterstr)
+        for dn, data in self.db.execute(
+                'SELECT e.dn, e.data FROM entries e WHERE (%s) AND %s '
+                'ORDER BY e.id' % (where, cond), params + cond_params):
+            yield dn, pickle.loads(str(data))
+
+    def close(self):
+        self.db.close()
@@ -1,19 +1,20 @@
 import re
 import os
+import sys
 import json
+import glob
 import base64
 from sys import stderr
 from string import Template
 from os.path import dirname
 from getpass import getpass
 from copy import deepcopy
-from argparse import ArgumentParser
-from collections import namedtuple
+from argparse import ArgumentParser, ArgumentTypeError
+from collections import namedtuple, OrderedDict
 
-import ldapvi
 
-
-UnitSpec = namedtuple('UnitSpec', 'single plural key')
+# attrs are the attributes listed by default, None for all of them
+UnitSpec = namedtuple('UnitSpec', 'single plural key attrs')
 
 
 DEFAULT_CONF_NAME = '~/.ldaptuna'
@@ -33,15 +34,32 @@ DEFAULT_BINDDN_FMT = 'uid={user},ou=people,' + BASEDN
 
 URI_TEMPLATE = 'ldap://{server}.tuna.tsinghua.edu.cn'
 
+# The first server is the master; the rest are read-only replicas.
 SERVERS = ['ldap', 'ldap2']
 
+# Search scopes, as known to ldapvi.SCOPES.
+SCOPES = ['base', 'one', 'sub']
+
+# Pseudo-server for -H: race all SERVERS and use the first to bind.
+AUTO_SERVER = 'auto'
+
+# Remembered connection latencies, to try the fastest server first.
+LATENCY_FILE = '~/.cache/ldaptuna/latency.json'
+
+# Weight of the latest measurement in the remembered latency.
+LATENCY_ALPHA = 0.3
+
+# Subcommands that write; with -H auto they always go to the master.
+WRITERS = ('apply', 'edit', 'new')
+
 UNITS = [
-    UnitSpec('person', 'people', 'uid'),
-    UnitSpec('robot', 'robots', 'cn'),
-    UnitSpec('domain', 'domains', 'cn'),
-    UnitSpec('dnsdomain2', 'domains', 'dc'),
-    UnitSpec('host', 'hosts', 'cn'),
-    UnitSpec('group', 'groups', 'cn'),
+    UnitSpec('person', 'people', 'uid', ['uid', 'cn', 'displayName', 'mail']),
+    UnitSpec('robot', 'robots', 'cn', ['cn']),
+    UnitSpec('domain', 'domains', 'cn',
+             ['cn', 'aliasedObjectName', 'ipHostNumber', 'description']),
+    UnitSpec('dnsdomain2', 'domains', 'dc', None),
+    UnitSpec('host', 'hosts', 'cn', ['cn', 'ipHostNumber', 'tunaOs']),
+    UnitSpec('group', 'groups', 'cn', None),
 ]
 
 UNIT_MAP = {u.single: u for u in UNITS}
@@ -51,6 +69,13 @@ UNIT_CNAME = {u.single: u.plural for u in UNITS}
 # UNIT_NAMES = UNIT_CNAME.keys() + UNIT_CNAME.values()
 UNIT_NAMES = UNIT_CNAME.keys()
 
+# Groups under ou=groups of each host granting access to it, and what they
+# grant; other groups are reported by their cn.
+HOST_ROLES = {'users': 'login', 'tuna-sudo': 'sudo'}
+
+# A version line before the first record of an LDIF file.
+LDIF_VERSION = re.compile(r'\A((?:[ \t]*\n|#.*\n)*)version:.*\n')
+
 
 def myinput(prompt=''):
     '''Like raw_input, but prints the prompt to stderr.'''
@@ -122,6 +147,140 @@ Default profile name: ''')
     return binddn, bindpw
 
 
+def read_latencies():
+    try:
+        with open(os.path.expanduser(LATENCY_FILE)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_latencies(latencies, measured):
+    '''
+    Fold latencies measured in this run into the remembered ones and save
+    them.
+    '''
+    for uri, t in measured.items():
+        old = latencies.get(uri)
+        latencies[uri] = t if old is None else \
+            LATENCY_ALPHA * t + (1 - LATENCY_ALPHA) * old
+    fname = os.path.expanduser(LATENCY_FILE)
+    try:
+        if not os.path.isdir(dirname(fname)):
+            os.makedirs(dirname(fname))
+        with open(fname, 'w') as f:
+            json.dump(latencies, f, indent=2)
+    except (IOError, OSError):
+        # Only a hint for next time
+        pass
+
+
+def choose_uris(server, write, latencies):
+    '''
+    Return the URI or list of URIs to connect to. With server AUTO_SERVER,
+    writes go to the master and reads to all SERVERS, fastest first.
+    '''
+    if server != AUTO_SERVER:
+        return URI_TEMPLATE.format(server=server)
+    if write:
+        return URI_TEMPLATE.format(server=SERVERS[0])
+    uris = [URI_TEMPLATE.format(server=s) for s in SERVERS]
+    # Servers never measured go first, so that they get measured
+    return sorted(uris, key=lambda uri: latencies.get(uri, 0))
+
+
+def ldif_files(path):
+    '''
+    Expand path, which may name a file, a directory (meaning the *.ldif
+    files therein) or a glob pattern, to a sorted list of file names. '-'
+    stands for stdin.
+    '''
+    if path == '-':
+        return [path]
+    if os.path.isdir(path):
+        path = os.path.join(path, '*.ldif')
+    elif os.path.exists(path):
+        return [path]
+    return sorted(glob.glob(path))
+
+
+def read_ldif(fnames):
+    '''
+    Read and concatenate LDIF files into a single LDIF document.
+    '''
+    chunks = []
+    for fname in fnames:
+        if fname == '-':
+            ldif = sys.stdin.read()
+        else:
+            with open(fname) as f:
+                ldif = f.read()
+        # Only one version line is allowed, at the very beginning
+        chunks.append(LDIF_VERSION.sub(r'\1', ldif, 1))
+    return '\n\n'.join(chunks)
+
+
+def read_vars(fname):
+    '''
+    Read template variables from a CSV file with a header row naming them,
+    or a JSON list of objects, one per entity. '-' stands for stdin. Return
+    a list of dicts.
+    '''
+    if fname == '-':
+        data = sys.stdin.read()
+    else:
+        with open(fname) as f:
+            data = f.read()
+    if data.lstrip().startswith('['):
+        def encode(v):
+            if isinstance(v, list):
+                return [encode(x) for x in v]
+            return unicode(v).encode('utf-8')
+        return [dict((str(k), encode(v)) for k, v in row.items())
+                for row in json.loads(data)]
+    import csv
+    return list(csv.DictReader(data.splitlines()))
+
+
+class EntityTemplate(object):
+    '''
+    An LDIF template for new, compiled once and rendered for each entity.
+
+    Variables are substituted for $placeholders as by string.Template; the
+    others fill in the first attribute of the same name left empty in the
+    template, one line per value if given a list.
+    '''
+    def __init__(self, text):
+        self.template = Template(text)
+        self.placeholders = set(
+            m.group('named') or m.group('braced')
+            for m in self.template.pattern.finditer(text))
+        self._empty = {}
+
+    def _empty_attr(self, attr):
+        if attr not in self._empty:
+            self._empty[attr] = re.compile(
+                r'^%s:[ \t]*$' % re.escape(attr), re.I | re.M)
+        return self._empty[attr]
+
+    def render(self, vars):
+        ldif = self.template.safe_substitute(vars)
+        for attr, values in vars.items():
+            if attr in self.placeholders or not values:
+                continue
+            if not isinstance(values, list):
+                values = [values]
+            lines = []
+            for v in values:
+                if '\n' in v or v[:1] in (' ', ':', '<'):
+                    lines.append('%s:: %s' % (attr, base64.b64encode(v)))
+                else:
+                    lines.append('%s: %s' % (attr, v))
+            ldif = self._empty_attr(attr).sub(
+                lambda m: '\n'.join(lines), ldif, 1)
+        return ldif
+
+
 def map_to_dn(basedn, unit, entity):
     _unit = UNIT_CNAME[unit] \
         if unit in UNIT_CNAME.keys() else unit
@@ -132,17 +291,129 @@ def map_to_dn(basedn, unit, entity):
     return dn
 
 
-def mk_argparser():
+class AccessIndex(object):
+    '''
+    Who may log into or sudo on which host, from the groups under the hosts
+    with their members, indexed both ways.
+    '''
+    def __init__(self):
+        # dn_key of member -> {host: set of roles}
+        self.by_member = {}
+        # Lowercased host -> (host, {role: member DNs})
+        self.by_host = {}
+
+    def update(self, entries):
+        '''
+        Index (dn, entry) tuples of groups cn=GROUP,ou=groups,cn=HOST,...
+        '''
+        # Imported by main already
+        import ldap.dn
+        from ldapvi import dn_key
+        for dn, entry in entries:
+            rdns = ldap.dn.str2dn(dn)
+            if len(rdns) < 3:
+                continue
+            group, host = rdns[0][0][1], rdns[2][0][1]
+            role = HOST_ROLES.get(group, group)
+            host, roles = self.by_host.setdefault(host.lower(), (host, {}))
+            members = roles.setdefault(role, [])
+            for member in entry.get('member', ()):
+                if not member:
+                    continue
+                members.append(member)
+                self.by_member.setdefault(dn_key(member), {}).setdefault(
+                    host, set()).add(role)
+
+    def print_member(self, dn):
+        from ldapvi import dn_key
+        hosts = self.by_member.get(dn_key(dn), {})
+        print('%s:' % dn)
+        for host in sorted(hosts):
+            print('    %s %s' % (host, ' '.join(sorted(hosts[host]))))
+
+    def print_host(self, host):
+        host, roles = self.by_host.get(host.lower(), (host, {}))
+        print('%s:' % host)
+        for role in sorted(roles):
+            for member in sorted(roles[role]):
+                print('    %s %s' % (role, member))
+
+
+def positive_int(s):
+    '''
+    Convert an option value to an int, refusing values below 1.
+    '''
+    n = int(s)
+    if n < 1:
+        raise ArgumentTypeError('must be at least 1: %r' % s)
+    return n
+
+
+def _find_subcommand(parser, argv):
+    '''
+    Return the first positional argument in argv, skipping the global
+    options of parser and their values, or None if there is none.
+    '''
+    takes_value = [opt for opt, action in
+                   parser._option_string_actions.items() if action.nargs != 0]
+    args = iter(argv)
+    for arg in args:
+        if arg == '--':
+            return next(args, None)
+        elif not arg.startswith('-') or arg == '-':
+            return arg
+        elif '=' not in arg and any(
+                opt == arg or arg.startswith('--') and opt.startswith(arg)
+                for opt in takes_value):
+            next(args, None)
+    return None
+
+
+def mk_argparser(argv=None):
     '''
     Build and return the main ArgumentParser.
+
+    If argv is given, only the subparser of the subcommand it names is
+    filled in, which is all parse_args(argv) needs; the others are left
+    empty to save startup time.
     '''
     parser = ArgumentParser(description="TUNA's LDAP tool", prog='ldaptuna')
     parser.add_argument('-p', '--profile',
                         help='profile stored in ~/%s' % get_conf_name())
     parser.add_argument('-H', '--server', metavar='server', default='ldap',
-                        choices=SERVERS,
+                        choices=SERVERS + [AUTO_SERVER],
                         help='''
-        which server to query, possible values are %(choices)s
+        which server to query, possible values are %(choices)s. With auto,
+        reads go to whichever server binds first, trying the one fastest
+        last time first; writes go to the master (the first server)
+                        ''')
+    parser.add_argument('--timeout', type=float, help='''
+        seconds to wait for a server to connect and bind before giving up or,
+        with -H auto, failing over to another server
+                        ''')
+    parser.add_argument('--pagesize', type=int, help='''
+        number of entries to request per page of search results; 0 disables
+        paging
+                        ''')
+    parser.add_argument('--window', type=positive_int, help='''
+        maximum number of write operations to keep in flight when applying
+        changes
+                        ''')
+    parser.add_argument('-j', '--jobs', type=int, help='''
+        number of processes writing and parsing the LDIF of large subtrees;
+        default and at most one per CPU, 1 to use a single process
+                        ''')
+    parser.add_argument('--no-agent', dest='agent', action='store_false',
+                        default=True, help='''
+        connect directly even if ldapagent is running
+                        ''')
+    parser.add_argument('--timings', action='store_true', default=False,
+                        help='''
+        print the time spent connecting, searching, editing, applying etc.
+        and the number and latencies of operations to stderr
+                        ''')
+    parser.add_argument('--timings-json', metavar='FILE', help='''
+        write the same as --timings as JSON to FILE
                         ''')
 
     subparsers = parser.add_subparsers(
@@ -152,117 +423,425 @@ def mk_argparser():
 
     # Parent parser for apply, edit, list and new - the porcelain commands,
     # operating on the level of units and entities
-    advcmd = ArgumentParser(add_help=False)
-    advcmd.add_argument('unit', choices=UNIT_NAMES, metavar='unit',
-                        help='''
-        which part of LDAP (organizational unit) to operate on. Possible
-        values are %(choices)s. Plural/singular pairs like people/person and
-        domains/domain are equivalent
-                        ''')
-    advcmd.add_argument('entity', nargs='?', default='',
-                        help='''
-        which entity in selected unit to operate on. When omitted, operate on
-        all entities within the selected unit.
-                        ''')
+    def advcmd(many=False):
+        advcmd = ArgumentParser(add_help=False)
+        advcmd.add_argument('unit', choices=UNIT_NAMES, metavar='unit',
+                            help='''
+            which part of LDAP (organizational unit) to operate on. Possible
+            values are %(choices)s. Plural/singular pairs like people/person
+            and domains/domain are equivalent
+                            ''')
+        if many:
+            advcmd.add_argument('entity', nargs='*', help='''
+                which entities in selected unit to operate on
+                                ''')
+        else:
+            advcmd.add_argument('entity', nargs='?', default='',
+                                help='''
+                which entity in selected unit to operate on. When omitted,
+                operate on all entities within the selected unit.
+                                ''')
+        return advcmd
 
     # Parent parser for commands that perform LDAP search (apply, edit and
     # list)
-    searcher = ArgumentParser(add_help=False, parents=[advcmd])
-    searcher.add_argument('-r', '-R', '--recursive', action='store_true',
-                          default=False, help='list/modify subelements too')
+    def searcher():
+        searcher = ArgumentParser(add_help=False, parents=[advcmd()])
+        searcher.add_argument('-r', '-R', '--recursive', action='store_true',
+                              default=False,
+                              help='list/modify subelements too')
+        searcher.add_argument('--no-cache', dest='cache',
+                              action='store_false', default=True, help='''
+            search the server from scratch instead of refreshing the local
+            cache
+                              ''')
+        return searcher
 
     # A dummy ArgumentParser to define the file argument of apply command.
     # This is needed since there is no "insert_argument"...
-    _apply_file = ArgumentParser(add_help=False)
-    _apply_file.add_argument('file',
-                             help='''
-        LDIF file to apply against the search results
-                             ''')
+    def apply_file():
+        _apply_file = ArgumentParser(add_help=False)
+        _apply_file.add_argument('file',
+                                 help='''
+            LDIF to apply against the search results: a file, a directory of
+            *.ldif files, a quoted glob pattern or - for stdin. Several files
+            are applied together, as if concatenated
+                                 ''')
+        _apply_file.add_argument('-y', '--yes', action='store_true',
+                                 default=False,
+                                 help="don't ask for confirmation")
+        _apply_file.add_argument('-n', '--dry-run', action='store_true',
+                                 default=False, help='''
+            only print the operations that would be performed
+                                 ''')
+        _apply_file.add_argument('--txn-size', type=int, help='''
+            group up to this many operations (default 100) into one
+            transaction when the server supports LDAP transactions (RFC
+            5805); 0 disables transactions
+                                 ''')
+        _apply_file.add_argument('--delete', action='store_true',
+                                 default=False, help='''
+            also delete entries missing from file; searches the whole unit
+            instead of looking up the entries in file
+                                 ''')
+        _apply_file.add_argument('--assert', dest='assertions',
+                                 action='store_true', default=False,
+                                 help='''
+            fail to modify or delete entries modified on the server since
+            they were looked up
+                                 ''')
+        _apply_file.add_argument('--resume', action='store_true',
+                                 default=False, help='''
+            finish applying file after a failure, from its journal, without
+            searching again
+                                 ''')
+        return _apply_file
+
+    # Parent parser for commands that output search results (list and
+    # search)
+    def lister():
+        lister = ArgumentParser(add_help=False)
+        lister.add_argument('--sort', action='store_true', default=False,
+                            help='''
+            collect all results and output parents before their children. By
+            default entries are streamed in the order the server sends them
+                            ''')
+        lister.add_argument('--attrs', help='''
+            comma-separated attributes to output, or * for all of them.
+            Listing a whole unit defaults to a few attributes of interest;
+            otherwise all are output
+                            ''')
+        lister.add_argument('--attrs-only', action='store_true',
+                            default=False, help='''
+            output attribute types without their values
+                            ''')
+        lister.add_argument('--interleave', action='store_true',
+                            default=False, help='''
+            with several units or bases, output entries as they arrive
+            rather than one unit or base after another
+                            ''')
+        return lister
+
+    # Parent parser for commands that use a snapshot (search and snapshot)
+    def snapshotter():
+        snapshotter = ArgumentParser(add_help=False)
+        snapshotter.add_argument('--snapshot', metavar='FILE', help='''
+            snapshot file, by default one per bind DN in ~/.cache/ldapvi
+                                 ''')
+        return snapshotter
 
     def new_subcommand(name, **kwargs):
         return subparsers.add_parser(name, **kwargs)
 
-    new_subcommand('apply', parents=[_apply_file, searcher])
-    new_subcommand('edit', parents=[searcher], description='''
-        fire an external editor to edit designated entity
-        ''')
-    new_subcommand('list', parents=[searcher], description='''
-        output designated entity to stdout
-        ''')
-    new = new_subcommand('new', parents=[advcmd], description='''
-              create designated entity from a template
-              ''')
-    new.add_argument('-t', '--template', default='', help='''
-        If non-empty, use a template named <unit>.<template>.ldif instead of
-        the default <unit>.ldif. The template is still looked for in the
-        same template directory.
-        ''')
+    def build_apply(name):
+        new_subcommand(name, parents=[apply_file(), searcher()])
+
+    def build_edit(name):
+        edit = new_subcommand(name, parents=[searcher()], description='''
+            fire an external editor to edit designated entity
+            ''')
+        edit.add_argument('--omit-binary', action='store_true', default=False,
+                          help='''
+            do not fetch photos and certificates; they are left alone unless
+            their placeholders are removed or replaced
+                          ''')
+        edit.add_argument('--no-sidecars', dest='sidecars',
+                          action='store_false', default=True, help='''
+            write large and binary values inline in the draft
+                          ''')
+
+    def build_list(name):
+        list_ = new_subcommand(name, parents=[searcher(), lister()],
+                               description='''
+            output designated entity to stdout
+            ''')
+        list_.add_argument('-u', '--unit', dest='units', action='append',
+                           default=[], choices=UNIT_NAMES, metavar='unit',
+                           help='''
+            list this unit too, searched at the same time over the same
+            connection; may be repeated
+                           ''')
+
+    def build_new(name):
+        new = new_subcommand(name, parents=[advcmd(many=True)],
+                             description='''
+                  create designated entities from a template, all in one
+                  editor session
+                  ''')
+        new.add_argument('-t', '--template', default='', help='''
+            If non-empty, use a template named <units>.<template>.ldif instead
+            of the default <units>.ldif. The template is still looked for in
+            the same template directory.
+            ''')
+        new.add_argument('--vars', metavar='FILE', help='''
+            create one entity per row of FILE, a CSV file with a header row
+            or a JSON list of objects (- for stdin). name is substituted for
+            $name; other variables fill in the empty attributes of the same
+            name
+            ''')
+        new.add_argument('--no-edit', dest='edit', action='store_false',
+                         default=True, help='''
+            apply the rendered template without opening an editor
+            ''')
+        new.add_argument('-y', '--yes', action='store_true', default=False,
+                         help="don't ask for confirmation")
 
     # search - the plumbing command (the only one for now)
-    search = new_subcommand('search', description='''
-        low-level LDAP search command
-        ''')
-    search.add_argument('-s', '--scope', default='sub',
-                        choices=ldapvi.SCOPES.keys())
-    search.add_argument('base')
-    search.add_argument('filterstr', nargs='?', default='')
+    def build_search(name):
+        search = new_subcommand(name, parents=[lister(), snapshotter()],
+                                description='''
+            low-level LDAP search command
+            ''')
+        search.add_argument('-s', '--scope', default='sub', choices=SCOPES)
+        search.add_argument('--offline', action='store_true', default=False,
+                            help='''
+            search the snapshot taken by the snapshot subcommand instead of
+            the server
+                            ''')
+        search.add_argument('base')
+        search.add_argument('-b', '--base', dest='bases', action='append',
+                            default=[], metavar='BASE', help='''
+            search this base too, at the same time over the same connection;
+            may be repeated
+                            ''')
+        search.add_argument('filterstr', nargs='?', default='')
+
+    def build_snapshot(name):
+        snapshot = new_subcommand(name, parents=[snapshotter()],
+                                  description='''
+            save a subtree to a local SQLite file for search --offline
+            ''')
+        snapshot.add_argument('base', nargs='?', default=BASEDN, help='''
+            root of the subtree to save (default: %(default)s)
+                              ''')
+
+    def build_access(name):
+        access = new_subcommand(name, description='''
+            show who may log into or sudo on which host, from the groups of
+            all hosts fetched in one search
+            ''')
+        access.add_argument('-u', '--user', action='append', default=[],
+                            help='''
+            show the hosts USER (a uid or a DN) has access to; may be
+            repeated
+                            ''')
+        access.add_argument('--host', action='append', default=[], help='''
+            show who has access to HOST; may be repeated. Without --user or
+            --host, show every host
+                            ''')
+        access.add_argument('--no-cache', dest='cache', action='store_false',
+                            default=True, help='''
+            search the server from scratch instead of refreshing the local
+            cache
+                            ''')
+
+    def build_watch(name):
+        watch = new_subcommand(name, parents=[advcmd()], description='''
+            print changes to designated entity as they happen, over one
+            connection kept open (syncrepl), until interrupted. A restart
+            picks up the changes made in the meantime
+            ''')
+        watch.add_argument('-r', '-R', '--recursive', action='store_true',
+                           default=False, help='watch subelements too')
+        watch.add_argument('--json', dest='output', action='store_const',
+                           const='json', default='ldif', help='''
+            print changes as JSON Lines instead of LDIF
+                           ''')
+        watch.add_argument('--initial', action='store_true', default=False,
+                           help='''
+            on the first run, also print the entities as they are
+                           ''')
 
     # nop - trigger profile creation
-    new_subcommand('nop', description='''
-        Do nothing but triggering profile creation
-        ''')
+    def build_nop(name):
+        new_subcommand(name, description='''
+            Do nothing but triggering profile creation
+            ''')
+
+    builders = [
+        ('apply', build_apply),
+        ('edit', build_edit),
+        ('list', build_list),
+        ('new', build_new),
+        ('search', build_search),
+        ('snapshot', build_snapshot),
+        ('access', build_access),
+        ('watch', build_watch),
+        ('nop', build_nop),
+    ]
+    wanted = None
+    if argv is not None:
+        wanted = _find_subcommand(parser, argv)
+        if wanted not in dict(builders):
+            # Let argparse complain about it
+            wanted = None
+    for name, build in builders:
+        if argv is None or name == wanted:
+            build(name)
+        else:
+            new_subcommand(name)
 
     return parser
 
 
 def main():
-    parser = mk_argparser()
-    args = parser.parse_args()
+    argv = sys.argv[1:]
+    parser = mk_argparser(argv)
+    args = parser.parse_args(argv)
 
-    uri = URI_TEMPLATE.format(server=args.server)
     ldif = filterstr = ''
     # Determine what to do
     subcommand = args.subcommand
-    if subcommand in ('apply', 'edit', 'list', 'new'):
+    latencies = read_latencies()
+    uri = choose_uris(args.server, subcommand in WRITERS, latencies)
+    if subcommand in ('apply', 'edit', 'list', 'new', 'watch'):
         action = subcommand
         unit = args.unit
         # Canonize unit name
         # if unit in UNIT_CNAME.keys():
         #     unit = UNIT_CNAME[unit]
+        if subcommand == 'new':
+            entities, args.entity = args.entity, ''
         base = map_to_dn(BASEDN, unit, args.entity)
 
         if 'recursive' in args and args.recursive:
             scope = 'sub'
         else:
             scope = args.entity and 'base' or 'one'
+        # Lets the server sort the entities of a unit for us
+        sort_key = UNIT_MAP[unit].key
+        units = [unit] + getattr(args, 'units', [])
+        if len(units) > 1:
+            if args.entity:
+                parser.error('an entity cannot be listed along with other '
+                             'units')
+            base = [map_to_dn(BASEDN, u, '') for u in units]
+            # Units are keyed by different attributes
+            sort_key = None
 
         if subcommand == 'new':
+            # Templates are named after the plural
             if args.template:
-                name = '%s.%s.ldif' % (unit, args.template)
+                name = '%s.%s.ldif' % (UNIT_CNAME[unit], args.template)
             else:
-                name = '%s.ldif' % unit
+                name = '%s.ldif' % UNIT_CNAME[unit]
             fname = os.path.join(dirname(dirname(__file__)), 'templates', name)
+            rows = [{'name': e} for e in entities]
+            if args.vars:
+                rows.extend(read_vars(args.vars))
+                if not all(row.get('name') for row in rows):
+                    parser.error('every entity in %s needs a name' %
+                                 args.vars)
             if os.path.exists(fname):
                 with open(fname) as f:
-                    vars = {}
-                    if args.entity:
-                        vars['name'] = args.entity
-                    template = Template(f.read())
-                    ldif = template.safe_substitute(**vars)
+                    template = EntityTemplate(f.read())
+                ldif = '\n'.join(template.render(vars).rstrip('\n') + '\n'
+                                  for vars in rows or [{}])
             else:
                 ldif = '# Template %s not found, create from scratch' % fname
+        elif subcommand == 'apply' and args.resume:
+            action = 'resume'
         elif subcommand == 'apply':
-            ldif = open(args.file).read()
+            fnames = ldif_files(args.file)
+            if not fnames:
+                parser.error('no LDIF files found at %s' % args.file)
+            if '-' in fnames and not (args.yes or args.dry_run):
+                parser.error('applying LDIF from stdin requires --yes or '
+                             '--dry-run')
+            ldif = read_ldif(fnames)
     elif subcommand == 'search':
-        action = 'list'
+        action = args.offline and 'query' or 'list'
         base, scope, filterstr = args.base, args.scope, args.filterstr
-
-    binddn, bindpw = get_bindinfo(args.profile, subcommand == 'nop')
+        if args.bases:
+            base = [base] + args.bases
+        sort_key = None
+    elif subcommand == 'snapshot':
+        action = 'snapshot'
+        base, scope = args.base, 'sub'
+        sort_key = None
+    elif subcommand == 'access':
+        action = 'report'
+        base, scope = map_to_dn(BASEDN, 'host', ''), 'sub'
+        filterstr = '(objectClass=tunaGroup)'
+        sort_key = None
+
+    attrlist = None
+    if subcommand in ('list', 'search'):
+        if args.attrs:
+            attrlist = args.attrs.split(',')
+        elif subcommand == 'list' and scope == 'one':
+            # Those of interest in all units, all if any unit wants all
+            wanted = [UNIT_MAP[u].attrs for u in units]
+            if None not in wanted:
+                attrlist = list(OrderedDict.fromkeys(sum(wanted, [])))
+    elif subcommand == 'access':
+        attrlist = ['member']
+
+    # No password needed to search a snapshot
+    offline = getattr(args, 'offline', False)
+    binddn, bindpw = get_bindinfo(args.profile, subcommand == 'nop' or offline)
 
     if subcommand != 'nop':
-        ldapvi.start(uri, binddn, bindpw,
-                     base=base, scope=scope, filterstr=filterstr,
-                     action=action, ldif=ldif)
+        # Imported only now, since python-ldap is slow to import
+        import ldapvi
+        # Options not given on the command line are left to ldapvi
+        options = dict((k, v) for k, v in [
+            ('pagesize', args.pagesize), ('window', args.window),
+            ('timeout', args.timeout), ('jobs', args.jobs),
+        ] if v is not None)
+        if subcommand == 'apply':
+            options['txn_size'] = ldapvi.DEFAULT_TXN_SIZE \
+                if args.txn_size is None else args.txn_size
+            # Journal the operations next to a single file, to resume from
+            if args.resume:
+                fnames = [args.file]
+            if len(fnames) == 1 and fnames != ['-']:
+                import ldapjournal
+                options['journal'] = ldapjournal.journal_path(fnames[0])
+        if args.timings or args.timings_json:
+            options['timings'] = ldapvi.Timings()
+        if subcommand == 'access':
+            index = AccessIndex()
+            options['report'] = index.update
+        if offline or subcommand == 'snapshot':
+            import ldapsnap
+            options['snapshot'] = args.snapshot or \
+                ldapsnap.default_path(binddn)
+        measured = {}
+        why = ldapvi.start(uri, binddn, bindpw,
+                           base=base, scope=scope, filterstr=filterstr,
+                           action=action, ldif=ldif,
+                           sort='sort' in args and args.sort,
+                           agent=args.agent,
+                           cache='cache' in args and args.cache,
+                           latencies=measured, sort_key=sort_key,
+                           attrlist=attrlist,
+                           attrs_only=getattr(args, 'attrs_only', False),
+                           interleave=getattr(args, 'interleave', False),
+                           omit_binary=getattr(args, 'omit_binary', False),
+                           sidecars=getattr(args, 'sidecars', True),
+                           assume_yes=getattr(args, 'yes', False),
+                           edit=getattr(args, 'edit', True),
+                           delete=getattr(args, 'delete', False),
+                           assertions=getattr(args, 'assertions', False),
+                           output=getattr(args, 'output', 'ldif'),
+                           initial=getattr(args, 'initial', False),
+                           dry_run=getattr(args, 'dry_run', False),
+                           **options)
+        if subcommand == 'access' and not why:
+            for user in args.user:
+                index.print_member(user if '=' in user
+                                   else map_to_dn(BASEDN, 'person', user))
+            for host in args.host:
+                index.print_host(host)
+            if not (args.user or args.host):
+                for host in sorted(index.by_host):
+                    index.print_host(host)
+        if measured:
+            save_latencies(latencies, measured)
+        if 'timings' in options:
+            ldapvi.report_timings(options['timings'], args.timings,
+                                  args.timings_json)
 
 
 if __name__ == '__main__':
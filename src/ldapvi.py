@@ -1,16 +1,33 @@
 import os
+import re
 import sys
+import errno
+import base64
+import shutil
+import urllib
+import urlparse
+import json
+import hashlib
+import marshal
+import threading
+from time import time, sleep
+from Queue import Queue, Empty
+from bisect import bisect_left
 from subprocess import check_call, CalledProcessError
-from argparse import ArgumentParser
-from collections import namedtuple, OrderedDict
+from argparse import ArgumentParser, ArgumentTypeError
+from collections import namedtuple, OrderedDict, deque
 from tempfile import mkstemp
 from getpass import getpass
 from cStringIO import StringIO
 
 import ldap
+import ldap.dn
 import ldap.modlist
 import ldif
 from ldap import LDAPError
+from ldap.controls import SimplePagedResultsControl, RequestControl, \
+    ResponseControl, KNOWN_RESPONSE_CONTROLS
+from ldap.extop import ExtendedRequest
 
 
 SCOPES = {
@@ -19,6 +36,77 @@ SCOPES = {
     'sub': ldap.SCOPE_SUBTREE
 }
 
+# Number of recently parsed DNs remembered by dn_key; see lru_memoize.
+DN_MEMO_SIZE = 65536
+
+# Maximum number of write operations in flight when applying changes.
+DEFAULT_WINDOW = 16
+
+# Seconds allowed for connecting, StartTLS and binding to a server.
+DEFAULT_TIMEOUT = 5
+
+# Seconds between starting successive connection attempts in a race.
+DEFAULT_STAGGER = 0.2
+
+# Number of operations grouped into one LDAP transaction by apply_changes;
+# 0 disables transactions.
+DEFAULT_TXN_SIZE = 100
+
+# LDAP Transactions (RFC 5805): Start/End Transaction extended operations
+# and the Transaction Specification control.
+TXN_START = '1.3.6.1.1.21.1'
+TXN_SPEC = '1.3.6.1.1.21.2'
+TXN_END = '1.3.6.1.1.21.3'
+
+# Server Side Sort request and response controls (RFC 2891).
+SSS_CONTROL = '1.2.840.113556.1.4.473'
+SSS_RESULT_CONTROL = '1.2.840.113556.1.4.474'
+
+# Assertion control (RFC 4528).
+ASSERTION_CONTROL = '1.3.6.1.1.12'
+
+# Seconds to wait before reconnecting when the connection of a watch is
+# lost.
+WATCH_RETRY = 5
+
+# Number of entries requested per page by paged searches; 0 disables paging.
+DEFAULT_PAGESIZE = 500
+
+# Number of entries from which LDIF is written and parsed by a pool of
+# worker processes, see parallel_map.
+PARALLEL_MIN = 20000
+
+# Minimum number of entries handed to a worker at a time.
+PARALLEL_CHUNK = 1000
+
+# Values of at least this many bytes, and binary ones, are written to sidecar
+# files by LDIFWriter when given a sidecar directory.
+SIDECAR_MIN = 4096
+
+# Attributes of binary syntaxes (RFC 4517, 4523 and 2798), only fetched on
+# request with Action.omit_binary.
+BINARY_ATTRS = frozenset([
+    'audio', 'authorityrevocationlist', 'cacertificate',
+    'certificaterevocationlist', 'crosscertificatepair', 'deltarevocationlist',
+    'jpegphoto', 'photo', 'usercertificate', 'userpkcs12',
+    'usersmimecertificate',
+])
+
+# Stands for the values of binary attributes not fetched. It is written in
+# base64 as OMITTED_B64, an ordinary value to any LDIF parser, and
+# modify_modlist keeps the attribute as is unless the value is removed
+# (deleting the attribute) or the values are replaced.
+OMITTED_B64 = 'omittedByLdapvi+'
+OMITTED = base64.b64decode(OMITTED_B64)
+
+# Entries deleted and added that share at least this fraction of their
+# telling values are taken as renamed; see find_renames.
+RENAME_SIMILARITY = 0.8
+
+# Values shared by more entries than this, e.g. filled in by a template, are
+# too common to tell entries apart.
+RENAME_FANOUT = 8
+
 _RETCODES = {
     '': 0,
     'cmdline': 2,
@@ -29,9 +117,167 @@ _RETCODES = {
 }
 
 
+class CompactEntry(object):
+    '''
+    A read-only LDAP entry taking a fraction of the memory of a dict of
+    lists.
+
+    Attribute types are interned and kept in a sorted tuple shared by all
+    entries with the same types, values are kept in tuples, and objectClass
+    values are interned. The read-only part of the dict interface is
+    supported, which is enough for ldap.modlist and LDIFWriter.
+    '''
+    __slots__ = ('_types', '_values')
+
+    # Attribute type tuples in use, so that entries can share them
+    _shared_types = {}
+
+    def __init__(self, entry=()):
+        if not isinstance(entry, dict):
+            entry = dict(entry)
+        items = sorted(entry.iteritems())
+        types = tuple(intern(attr) for attr, values in items)
+        self._types = self._shared_types.setdefault(types, types)
+        self._values = tuple(
+            tuple(intern(v) for v in values)
+            if attr.lower() == 'objectclass' else tuple(values)
+            for attr, values in items)
+
+    @classmethod
+    def from_parts(cls, types, values):
+        '''
+        Return a CompactEntry made of the _types and _values of another,
+        e.g. passed from another process with marshal, which keeps strings
+        interned.
+        '''
+        self = object.__new__(cls)
+        self._types = cls._shared_types.setdefault(types, types)
+        self._values = values
+        return self
+
+    def __getitem__(self, attr):
+        try:
+            return self._values[self._types.index(attr)]
+        except ValueError:
+            raise KeyError(attr)
+
+    def get(self, attr, default=None):
+        try:
+            return self[attr]
+        except KeyError:
+            return default
+
+    def __contains__(self, attr):
+        return attr in self._types
+
+    has_key = __contains__
+
+    def __iter__(self):
+        return iter(self._types)
+
+    iterkeys = __iter__
+
+    def __len__(self):
+        return len(self._types)
+
+    def keys(self):
+        return list(self._types)
+
+    def values(self):
+        return list(self._values)
+
+    def items(self):
+        return zip(self._types, self._values)
+
+    def itervalues(self):
+        return iter(self._values)
+
+    def iteritems(self):
+        return iter(zip(self._types, self._values))
+
+    def __eq__(self, other):
+        if isinstance(other, CompactEntry):
+            return (self._types == other._types and
+                    self._values == other._values)
+        if hasattr(other, 'keys'):
+            if len(other) != len(self._types):
+                return False
+            for attr, values in zip(self._types, self._values):
+                if attr not in other or tuple(other[attr]) != values:
+                    return False
+            return True
+        return NotImplemented
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        return eq if eq is NotImplemented else not eq
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'CompactEntry(%r)' % dict(self.iteritems())
+
+    def __reduce__(self):
+        return CompactEntry, (self.items(),)
+
+
 class LDIFParser(ldif.LDIFParser):
+    '''
+    A LDIFParser making CompactEntry entries.
+
+    Values are read from file:// URLs only if sidecar_dir is given, and only
+    from the files right in it, as written there by LDIFWriter: the LDIF may
+    come from anywhere, and must not get other local files uploaded.
+    '''
+    def __init__(self, input_file, sidecar_dir=None, **kw):
+        ldif.LDIFParser.__init__(self, input_file, **kw)
+        self.sidecar_dir = sidecar_dir and os.path.realpath(sidecar_dir)
+        # The line last unfolded, for _read_url
+        self._unfolded = None
+
+    # The base class reads lines with _unfoldLDIFLine or _unfold_lines, and
+    # pairs with _parseAttrTypeandValue or _next_key_and_value, depending on
+    # the version of python-ldap
+    def _unfoldLDIFLine(self):
+        self._unfolded = ldif.LDIFParser._unfoldLDIFLine(self)
+        return self._unfolded
+
+    def _unfold_lines(self):
+        self._unfolded = ldif.LDIFParser._unfold_lines(self)
+        return self._unfolded
+
+    def _parseAttrTypeandValue(self):
+        return self._read_url(*ldif.LDIFParser._parseAttrTypeandValue(self))
+
+    def _next_key_and_value(self):
+        return self._read_url(*ldif.LDIFParser._next_key_and_value(self))
+
+    def _read_url(self, attr_type, attr_value):
+        # The base class leaves values of URLs it does not read as None,
+        # which older versions take for the end of the record
+        if attr_value is not None or attr_type in (None, '-'):
+            return attr_type, attr_value
+        line = self._unfolded
+        colon = line.index(':')
+        if line[colon:colon + 2] != ':<':
+            return attr_type, attr_value
+        url = urlparse.urlparse(line[colon + 2:].strip())
+        path = os.path.realpath(urllib.url2pathname(url.path))
+        if not self.sidecar_dir or url.scheme != 'file' or url.netloc or \
+                os.path.dirname(path) != self.sidecar_dir:
+            raise ValueError('cannot read value of %s from %s; only '
+                             'sidecar files are read' %
+                             (attr_type, url.geturl()))
+        try:
+            with open(path, 'rb') as f:
+                return attr_type, f.read()
+        except IOError as e:
+            raise ValueError('cannot read value of %s: %s' % (attr_type, e))
+
     def handle(self, dn, entry):
-        self._entries[dn] = entry
+        if dn is None:
+            raise ValueError('record without a dn: line')
+        self._entries[intern(dn)] = CompactEntry(entry)
 
     def parse(self):
         self._entries = OrderedDict()
@@ -39,6 +285,194 @@ class LDIFParser(ldif.LDIFParser):
         return self._entries
 
 
+def compact_entries(entries):
+    '''
+    Turn an iterable of (dn, entry) tuples from a search into (dn,
+    CompactEntry) tuples, interning DNs so that they are shared with the
+    ones parsed by LDIFParser.
+    '''
+    for dn, entry in entries:
+        yield intern(dn), CompactEntry(entry)
+
+
+def fingerprint(block):
+    '''
+    Return the fingerprint of an LDIF record block, as recorded by
+    Action.write_entries and looked up by parse_ldif.
+    '''
+    return hashlib.sha1(block).digest()
+
+
+# The list parallel_map works on, inherited by its workers through fork
+_shared_items = None
+
+
+def _map_chunk(args):
+    func, start, end, extra = args
+    return func(_shared_items[start:end], *extra)
+
+
+def pool_size(jobs, n):
+    '''
+    Return the number of worker processes to handle n entries with, given
+    jobs as in Action.jobs, or 0 if they are better handled in this process.
+    '''
+    if jobs == 1 or n < PARALLEL_MIN:
+        return 0
+    # Imported only now, as few runs are large enough to need it
+    import multiprocessing
+    # Workers beyond one per CPU only add overhead
+    jobs = min(jobs or multiprocessing.cpu_count(),
+               multiprocessing.cpu_count())
+    return jobs if jobs > 1 else 0
+
+
+def parallel_map(func, items, jobs, *extra):
+    '''
+    Yield func(chunk, *extra) for successive chunks of the list items, in
+    order, computed by jobs worker processes. func must be a module-level
+    function.
+
+    The workers are forked with items in place, so only the results are
+    passed between processes.
+    '''
+    import multiprocessing
+    global _shared_items
+    size = max(PARALLEL_CHUNK, -(-len(items) // (jobs * 4)))
+    _shared_items = items
+    try:
+        pool = multiprocessing.Pool(jobs)
+    finally:
+        _shared_items = None
+    try:
+        for result in pool.imap(_map_chunk, [
+                (func, i, i + size, extra)
+                for i in xrange(0, len(items), size)]):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _parse_chunk(blocks, sidecar_dir=None):
+    parser = LDIFParser(StringIO('\n\n'.join(blocks)), sidecar_dir)
+    # marshal is much faster than pickle, and entries are quick to rebuild
+    # from their parts; see CompactEntry.from_parts
+    return marshal.dumps([(dn, entry._types, entry._values)
+                          for dn, entry in parser.parse().iteritems()])
+
+
+def _unparse_chunk(entries, with_fingerprints, sidecar_dir=None):
+    '''
+    Return the LDIF of a list of (dn, entry) tuples, and the fingerprints of
+    the records if with_fingerprints is true.
+    '''
+    buf = StringIO()
+    writer = LDIFWriter(buf, sidecar_dir=sidecar_dir)
+    if not with_fingerprints:
+        for dn, attrs in entries:
+            writer.unparse(dn, attrs)
+        return buf.getvalue(), None
+    records = []
+    for dn, attrs in entries:
+        writer.unparse(dn, attrs)
+        records.append(buf.getvalue())
+        buf.seek(0)
+        buf.truncate()
+    # Leave out the line end of the last line and the empty line separating
+    # records, like parse_ldif does
+    return ''.join(records), [fingerprint(r[:-2]) for r in records]
+
+
+def parse_blocks(blocks, jobs=1, sidecar_dir=None):
+    '''
+    Parse a list of LDIF record blocks, as split by parse_ldif, into an
+    OrderedDict. Many blocks are parsed in chunks by a pool of processes;
+    see pool_size.
+    '''
+    workers = pool_size(jobs, len(blocks))
+    if not workers:
+        return LDIFParser(StringIO('\n\n'.join(blocks)),
+                          sidecar_dir).parse()
+    entries = OrderedDict()
+    for chunk in parallel_map(_parse_chunk, blocks, workers, sidecar_dir):
+        for dn, types, values in marshal.loads(chunk):
+            entries[dn] = CompactEntry.from_parts(types, values)
+    return entries
+
+
+# A version line, after comments if any, at the start of a block
+_VERSION_LINE = re.compile(r'(?:#.*\n(?: .*\n)*)*version:')
+
+
+def parse_ldif(data, old=None, fingerprints=None, jobs=1, sidecar_dir=None):
+    '''
+    Parse LDIF data into an OrderedDict mapping DNs to entries.
+
+    fingerprints, if given, maps fingerprints of records written earlier to
+    their DNs. Blocks between empty lines whose fingerprints are found are
+    taken from old instead of being parsed again, so that only the records
+    edited since are parsed. Long runs of other blocks are parsed by jobs
+    processes, see parse_blocks. Values are read from the files in
+    sidecar_dir that data refers to, see LDIFParser. The result is the same
+    as that of a full parse; in the rare cases where taking a block on its
+    own might change its meaning (a block starting with a continuation line,
+    CRLF line ends, a misplaced version line, or a syntax error to be
+    reported), the whole of data is parsed instead.
+    '''
+    if '\r' in data or not fingerprints and \
+            not pool_size(jobs, data.count('\n\n')):
+        return LDIFParser(StringIO(data), sidecar_dir).parse()
+    fingerprints = fingerprints or {}
+
+    entries = OrderedDict()
+    run = []
+
+    def flush():
+        entries.update(parse_blocks(run, jobs, sidecar_dir))
+        del run[:]
+
+    try:
+        blocks = [b for b in (b.strip('\n') for b in data.split('\n\n'))
+                  if b]
+        for i, block in enumerate(blocks):
+            if block[0] == ' ':
+                raise ValueError('block starts with a continuation line')
+            if i and _VERSION_LINE.match(block):
+                # Only valid before the first record of the file
+                raise ValueError('misplaced version line')
+            dn = fingerprints and fingerprints.get(fingerprint(block))
+            if dn and dn in old:
+                if run:
+                    flush()
+                entries[dn] = old[dn]
+            else:
+                run.append(block)
+        if run:
+            flush()
+    except ValueError:
+        return LDIFParser(StringIO(data), sidecar_dir).parse()
+    return entries
+
+
+def _mk_width_table(widths, size):
+    '''
+    Expand a list of (last codepoint, width) ranges into a bytearray of the
+    widths of codepoints 0 to size - 1. SO and SI are zero-width.
+    '''
+    table = bytearray(size)
+    lo = 0
+    for num, wid in widths:
+        hi = min(num + 1, size)
+        table[lo:hi] = chr(wid) * (hi - lo)
+        lo = hi
+        if lo == size:
+            break
+    table[0xe] = table[0xf] = 0
+    return table
+
+
 class LDIFWriter(ldif.LDIFWriter):
     """
     A LDIFWriter with looser criteria for base64 encoding.
@@ -61,51 +495,99 @@ class LDIFWriter(ldif.LDIFWriter):
         (120831, 1), (262141, 2), (1114109, 1),
     ]
 
+    # Upper bounds of the ranges in _unicode_widths, for bisecting
+    _width_bounds = list(zip(*_unicode_widths)[0])
+
+    # Widths of all BMP codepoints, looked up by index
+    _bmp_widths = _mk_width_table(_unicode_widths, 0x10000)
+
+    # Lines consisting only of ASCII characters of width 1
+    _simple_line = re.compile(r'[\x00-\x0d\x10-\x7e]*\Z')
+
     def _unicode_width(self, o):
-        if o == 0xe or o == 0xf:
-            return 0
-        for num, wid in self._unicode_widths:
-            if o <= num:
-                return wid
+        if o <= 0xffff:
+            return self._bmp_widths[o]
+        i = bisect_left(self._width_bounds, o)
+        if i < len(self._unicode_widths):
+            return self._unicode_widths[i][1]
         return 1
 
+    def __init__(self, output_file, sidecar_dir=None, **kw):
+        '''
+        If sidecar_dir is given, values of SIDECAR_MIN bytes or more, and
+        those that are not UTF-8, are written to files there, named by the
+        SHA-1 of their content, and referred to as file:// URLs.
+        '''
+        ldif.LDIFWriter.__init__(self, output_file, **kw)
+        self.sidecar_dir = sidecar_dir
+        # The base class keeps it as _line_sep or _last_line_sep depending
+        # on the version of python-ldap
+        self.line_sep = kw.get('line_sep', '\n')
+
     def _count_width(self, line):
-        w = 0
-        for c in line:
-            w += self._unicode_width(ord(c))
-        return w
+        return sum(self._unicode_width(ord(c)) for c in line)
+
+    def _unparseAttrTypeandValue(self, attr_type, attr_value):
+        if attr_value == OMITTED:
+            self._unfoldLDIFLine('%s:: %s' % (attr_type, OMITTED_B64))
+        elif self.sidecar_dir and (len(attr_value) >= SIDECAR_MIN or
+                                   not _is_utf8(attr_value)):
+            path = write_sidecar(self.sidecar_dir, attr_value)
+            self._unfoldLDIFLine('%s:< file://%s' % (
+                attr_type, urllib.pathname2url(path)))
+        else:
+            ldif.LDIFWriter._unparseAttrTypeandValue(self, attr_type,
+                                                     attr_value)
+
+    def unparse(self, dn, record):
+        # The base class only accepts dicts as entries
+        if isinstance(record, CompactEntry):
+            record = dict(record.iteritems())
+        ldif.LDIFWriter.unparse(self, dn, record)
 
     def _unfoldLDIFLine(self, line):
-        first = True
-        line = line.decode('utf-8')
-        sum_width = 0
-        s = u''
-        all_width = self._count_width(line)
-        if all_width <= self._cols:
-            self._output_file.write(line.encode('utf-8'))
-            self._output_file.write(self._line_sep)
+        cols = self._cols
+        write = self._output_file.write
+        sep = self.line_sep
+        # The display width of UTF-8 never exceeds its length in bytes, so
+        # short lines need no decoding at all.
+        if len(line) <= cols:
+            write(line)
+            write(sep)
             return
-        for c in line:
-            wid = self._unicode_width(ord(c))
-            minus = 0
-            if not first:
-                minus = 1
-            if sum_width + wid > self._cols - minus:
-                if not first:
-                    self._output_file.write(' ')
-                else:
-                    first = False
-                self._output_file.write(s.encode('utf-8'))
-                self._output_file.write(self._line_sep)
-                s = '' + c
-                sum_width = wid
+
+        if self._simple_line.match(line):
+            # Every byte is one column wide; fold by length.
+            pieces = [line[:cols]]
+            pieces.extend(line[i:i + cols - 1]
+                          for i in xrange(cols, len(line), cols - 1))
+            write((sep + ' ').join(pieces))
+            write(sep)
+            return
+
+        line = line.decode('utf-8')
+        table = self._bmp_widths
+        pieces = []
+        start = width = 0
+        # Continuation lines lose one column to the leading space
+        limit = cols
+        for i, c in enumerate(line):
+            o = ord(c)
+            wid = table[o] if o <= 0xffff else self._unicode_width(o)
+            if width + wid > limit:
+                pieces.append(line[start:i])
+                start = i
+                width = wid
+                limit = cols - 1
             else:
-                s += c
-                sum_width += wid
-        if sum_width > 0:
-            self._output_file.write(' ')
-            self._output_file.write(s.encode('utf-8'))
-            self._output_file.write(self._line_sep)
+                width += wid
+        pieces.append(line[start:])
+        write((sep + ' ').join(pieces).encode('utf-8'))
+        write(sep)
+
+    def _unfold_lines(self, line):
+        # As called by newer versions of python-ldap
+        self._unfoldLDIFLine(line)
 
     def _needs_base64_encoding(self, attr_type, attr_value):
         if attr_type.lower() in self._base64_attrs:
@@ -119,6 +601,38 @@ class LDIFWriter(ldif.LDIFWriter):
             return True
 
 
+def _is_utf8(s):
+    try:
+        s.decode('utf-8')
+        return True
+    except UnicodeDecodeError:
+        return False
+
+
+def write_sidecar(dirname, value):
+    '''
+    Write value to a file in dirname named by its SHA-1, unless already
+    there, and return its absolute path. The file is read-only: a value is
+    changed by referring to another file, not by editing the sidecar.
+    '''
+    path = os.path.abspath(os.path.join(dirname,
+                                        hashlib.sha1(value).hexdigest()))
+    if os.path.exists(path):
+        return path
+    try:
+        os.mkdir(dirname, 0700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    # Write under another name first, since parallel writers may race
+    fd, tmp = mkstemp(dir=dirname)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(value)
+    os.chmod(tmp, 0400)
+    os.rename(tmp, path)
+    return path
+
+
 def exit(why):
     sys.exit(_RETCODES[why])
 
@@ -142,17 +656,191 @@ def fire_editor(fname):
     raw_input()
 
 
-memoized_split_dn = {}
-def split_dn(dn):
-    if dn not in memoized_split_dn:
-        li = dn.split(',')
-        li.reverse()
-        memoized_split_dn[dn] = li
-    return memoized_split_dn[dn]
+class _Phase(object):
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        # List phases in the order they are entered
+        self.timings.phases.setdefault(self.name, 0)
+        self.start = time()
+
+    def __exit__(self, *exc_info):
+        self.timings.phases[self.name] += time() - self.start
+
+
+class Timings(object):
+    '''
+    Wall time per phase, counters and latency histograms of an action.
+
+    Phases are timed with "with timings.phase(name):"; a phase entered
+    several times accumulates. Latencies are bucketed by powers of two
+    milliseconds.
+    '''
+    enabled = True
+
+    def __init__(self):
+        self.phases = OrderedDict()
+        self.counters = OrderedDict()
+        self.histograms = OrderedDict()
+
+    def phase(self, name):
+        return _Phase(self, name)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, seconds):
+        hist = self.histograms.get(name)
+        if hist is None:
+            hist = self.histograms[name] = {'count': 0, 'total': 0.0,
+                                            'max': 0.0, 'buckets': {}}
+        hist['count'] += 1
+        hist['total'] += seconds
+        hist['max'] = max(hist['max'], seconds)
+        bound = 1
+        while bound < seconds * 1000:
+            bound *= 2
+        hist['buckets'][bound] = hist['buckets'].get(bound, 0) + 1
+
+    def as_dict(self):
+        return {
+            'phases': self.phases,
+            'counters': self.counters,
+            'latencies': OrderedDict(
+                (name, dict(hist, buckets=OrderedDict(
+                    ('<%dms' % bound, n)
+                    for bound, n in sorted(hist['buckets'].items()))))
+                for name, hist in self.histograms.items()),
+        }
+
+    def summary(self):
+        lines = ['Timings:']
+        for name, seconds in self.phases.items():
+            lines.append('    %-20s %9.3fs' % (name, seconds))
+        for name, n in self.counters.items():
+            lines.append('    %-20s %9d' % (name, n))
+        for name, hist in self.histograms.items():
+            lines.append('    %-20s %9d ops, mean %.1fms, max %.1fms' % (
+                name + ' latency', hist['count'],
+                hist['total'] / hist['count'] * 1000, hist['max'] * 1000))
+            buckets = sorted(hist['buckets'].items())
+            lines.append('        ' + ', '.join(
+                '<%dms: %d' % bucket for bucket in buckets))
+        return '\n'.join(lines) + '\n'
+
+
+class _NullPhase(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class NullTimings(object):
+    '''
+    A stand-in for Timings recording nothing.
+    '''
+    enabled = False
+
+    _phase = _NullPhase()
+
+    def phase(self, name):
+        return self._phase
+
+    def count(self, name, n=1):
+        pass
+
+    def observe(self, name, seconds):
+        pass
+
+
+NULL_TIMINGS = NullTimings()
+
 
+def report_timings(timings, summary=False, json_fname=None):
+    '''
+    Print a summary of timings to stderr and/or save them as JSON.
+    '''
+    if summary:
+        sys.stderr.write(timings.summary())
+    if json_fname:
+        with open(json_fname, 'w') as f:
+            json.dump(timings.as_dict(), f, indent=2)
+            f.write('\n')
+
+
+def lru_memoize(size):
+    '''
+    Decorator memoizing a function of one hashable argument, remembering
+    about size recently used results.
+
+    The memo approximates LRU with two generations of dicts, which is much
+    cheaper than an ordered dict: hits in the old generation are promoted to
+    the new one, and when the new generation is full the old one is
+    dropped. At most 2 * size results are held.
+    '''
+    def decorator(f):
+        gens = [{}, {}]
+
+        def wrapper(arg):
+            new, old = gens
+            try:
+                return new[arg]
+            except KeyError:
+                pass
+            try:
+                value = old[arg]
+            except KeyError:
+                value = f(arg)
+            if len(new) >= size:
+                gens[:] = new, old = {}, new
+            new[arg] = value
+            return value
+
+        def clear():
+            gens[:] = {}, {}
+        wrapper.clear = clear
+        return wrapper
+    return decorator
+
+
+def _normalize(s):
+    '''
+    Normalize an attribute value for comparison: lower case, and whitespace
+    squeezed and stripped.
+    '''
+    return ' '.join(s.lower().split())
 
-def dn_cmp(dn1, dn2):
-    return cmp(split_dn(dn1), split_dn(dn2))
+
+@lru_memoize(DN_MEMO_SIZE)
+def dn_key(dn):
+    '''
+    Return a key for dn suitable for ordering and comparison.
+
+    The key is a tuple of normalized RDN strings from the root down, so a
+    parent's key is a prefix of its children's and sorts before them. Types
+    are lowercased, values normalized with _normalize, and multi-valued RDNs
+    have their AVAs sorted. DNs that python-ldap fails to parse are naively
+    split on ',' and '='.
+    '''
+    try:
+        rdns = ldap.dn.str2dn(dn)
+    except ldap.DECODING_ERROR:
+        rdns = [[ava.partition('=')[::2] for ava in rdn.split('+')]
+                for rdn in dn.split(',')]
+    key = []
+    for rdn in reversed(rdns):
+        if len(rdn) == 1:
+            # Fast path for the usual single-valued RDN
+            ava = rdn[0]
+            key.append(ava[0].lower() + '=' + _normalize(ava[1]))
+        else:
+            key.append('+'.join(sorted(
+                ava[0].lower() + '=' + _normalize(ava[1]) for ava in rdn)))
+    return tuple(key)
 
 
 def sort_entries(entries, reverse=False):
@@ -160,56 +848,927 @@ def sort_entries(entries, reverse=False):
     Sort LDAP entries by DN, ensuring parent elements appear before their
     children.
     '''
-    entries.sort(lambda a, b: dn_cmp(a[0], b[0]), reverse=reverse)
+    entries.sort(key=lambda e: dn_key(e[0]), reverse=reverse)
     return entries
 
 
-Changes = namedtuple('Changes', 'add modify delete')
+def topo_sort_entries(entries, reverse=False):
+    '''
+    Like sort_entries, but only guarantee that parents appear before their
+    children (children before parents if reverse is true); siblings keep
+    their relative order. Entries whose parent is absent are attached to
+    their nearest present ancestor, or treated as roots.
 
-def mkchanges(old, new):
+    Runs in linear time when parents are present. Return a new list.
+    '''
+    keys = [dn_key(e[0]) for e in entries]
+    index = dict(zip(keys, xrange(len(keys))))
+    children = {}
+    roots = []
+    for i, k in enumerate(keys):
+        parent = k[:-1]
+        j = index.get(parent)
+        while j is None and parent:
+            parent = parent[:-1]
+            j = index.get(parent)
+        if j is None or j == i:
+            roots.append(i)
+        else:
+            children.setdefault(j, []).append(i)
+
+    ordered = []
+    stack = roots[::-1]
+    while stack:
+        i = stack.pop()
+        ordered.append(entries[i])
+        if i in children:
+            stack.extend(reversed(children[i]))
+    if reverse:
+        ordered.reverse()
+    return ordered
+
+
+def search_iter(conn, base, scope, filterstr, attrlist=None,
+                pagesize=DEFAULT_PAGESIZE, attrsonly=0, serverctrls=None):
+    '''
+    Search with the Simple Paged Results control, yielding (dn, entry)
+    tuples page by page. serverctrls are sent along with the paging
+    control.
+
+    The request for the next page is sent before the current page is
+    yielded, so the server prepares page n+1 while the caller consumes page
+    n. Only one page is held in memory at a time. Servers that do not
+    support paging simply return everything as one page. A pagesize of 0
+    disables paging altogether.
+    '''
+    for i, page, done in search_many(conn, [base], scope, filterstr,
+                                     attrlist, pagesize, attrsonly,
+                                     serverctrls):
+        for dn, entry in page:
+            yield dn, entry
+
+
+def search_many(conn, bases, scope, filterstr, attrlist=None,
+                pagesize=DEFAULT_PAGESIZE, attrsonly=0, serverctrls=None,
+                responses=None):
+    '''
+    Search several bases at once over conn, like search_iter, yielding
+    (i, page, done) tuples as pages arrive: page is a list of (dn, entry)
+    tuples found under bases[i], and done is true on its last page. If
+    responses is a list, the response controls of the last pages are
+    appended to it.
+
+    All searches are issued before waiting for any result, so that the
+    total time is about that of the slowest. Searches still in progress
+    when the caller stops are abandoned.
+    '''
+    # msgid -> (index of base, paging control or None)
+    pending = {}
+
+    def request(i, page):
+        ctrls = list(serverctrls or ())
+        if page is not None:
+            ctrls.append(page)
+        msgid = conn.search_ext(bases[i], scope, filterstr, attrlist,
+                                attrsonly, serverctrls=ctrls)
+        pending[msgid] = i, page
+
+    try:
+        for i in xrange(len(bases)):
+            request(i, SimplePagedResultsControl(False, size=pagesize,
+                                                 cookie='')
+                    if pagesize else None)
+        while pending:
+            # Take whichever search has a page ready
+            rtype, rdata, rmsgid, rctrls = conn.result3(
+                ldap.RES_ANY if len(pending) > 1 else next(iter(pending)))
+            i, page = pending.pop(rmsgid)
+            done = True
+            for c in rctrls:
+                if c.controlType == SimplePagedResultsControl.controlType:
+                    if c.cookie and page is not None:
+                        page.cookie = c.cookie
+                        request(i, page)
+                        done = False
+                    break
+            if done and responses is not None:
+                responses.extend(rctrls)
+            # Skip search continuation references
+            yield i, [(dn, entry) for dn, entry in rdata
+                      if dn is not None], done
+    finally:
+        for msgid in pending:
+            try:
+                conn.abandon(msgid)
+            except LDAPError:
+                pass
+
+
+def fetch_entries(conn, dns, filterstr='(objectClass=*)', attrlist=None,
+                  window=DEFAULT_WINDOW):
+    '''
+    Look up the entries at dns matching filterstr with base searches,
+    keeping up to window in flight, and yield (dn, entry) tuples of those
+    found in the order of dns. Entries are yielded under the DN looked up,
+    however the server spells it.
+    '''
+    dns = iter(dns)
+    inflight = deque()
+    try:
+        while True:
+            for dn in dns:
+                inflight.append((conn.search_ext(dn, ldap.SCOPE_BASE,
+                                                 filterstr, attrlist), dn))
+                if len(inflight) >= window:
+                    break
+            if not inflight:
+                return
+            msgid, dn = inflight[0]
+            try:
+                rtype, rdata, rmsgid, rctrls = conn.result3(msgid)
+            except ldap.NO_SUCH_OBJECT:
+                rdata = []
+            inflight.popleft()
+            for found, entry in rdata:
+                if found is not None:
+                    yield dn, entry
+    finally:
+        for msgid, dn in inflight:
+            try:
+                conn.abandon(msgid)
+            except LDAPError:
+                pass
+
+
+def project(entry, attrlist=None, attrsonly=False):
+    '''
+    Return a copy of entry with only the attributes in attrlist, matched
+    case-insensitively; all of them if attrlist is None or contains '*'.
+    With attrsonly, the attributes have no values, as if searched for with
+    attrsonly.
+    '''
+    if attrlist is None or '*' in attrlist:
+        entry = dict(entry)
+    else:
+        wanted = set(a.lower() for a in attrlist)
+        entry = dict((k, v) for k, v in entry.iteritems()
+                     if k.lower() in wanted)
+    if attrsonly:
+        entry = dict.fromkeys(entry, [])
+    return entry
+
+
+def _normalize_int(s):
+    try:
+        return str(int(s))
+    except ValueError:
+        return s
+
+
+# Normalizers implementing the equality matching rules of common attributes,
+# keyed by lowercased attribute type. Values of other attributes are compared
+# byte for byte.
+VALUE_NORMALIZERS = dict(
+    [(a, _normalize) for a in (
+        # caseIgnoreMatch, caseIgnoreIA5Match and objectIdentifierMatch
+        'c', 'cn', 'dc', 'description', 'displayname', 'givenname',
+        'iphostnumber', 'l', 'mail', 'o', 'objectclass', 'ou', 'sn', 'st',
+        'street', 'title', 'uid')] +
+    [(a, _normalize_int) for a in (
+        # integerMatch
+        'gidnumber', 'uidnumber')] +
+    [(a, dn_key) for a in (
+        # distinguishedNameMatch
+        'manager', 'member', 'owner', 'roleoccupant', 'secretary',
+        'seealso')]
+)
+
+
+# Attributes matched ignoring case and spacing whose spelling still matters
+# to people, so that modify_modlist applies an edit of just that. The
+# spelling of object classes and DNs, which servers may rewrite, is left
+# alone.
+RESPELLABLE = frozenset(key for key, norm in VALUE_NORMALIZERS.iteritems()
+                        if norm is _normalize and key != 'objectclass')
+
+
+def _attr_values(entry):
+    '''
+    Map the lowercased attribute types of an entry to (type, values), where
+    values is an OrderedDict mapping normalized values to original ones.
+    Empty values are dropped, like ldap.modlist.addModlist does.
+    '''
+    attrs = {}
+    for attr, values in entry.items():
+        key = attr.lower()
+        norm = VALUE_NORMALIZERS.get(key)
+        attr, vmap = attrs.setdefault(key, (attr, OrderedDict()))
+        for v in values:
+            if v:
+                vmap.setdefault(norm(v) if norm else v, v)
+    return attrs
+
+
+def modify_modlist(old, new):
+    '''
+    Return a modlist turning entry old into entry new.
+
+    Unlike ldap.modlist.modifyModlist, attribute types are compared
+    case-insensitively and values as sets under the equality matching rule
+    of their attribute (see VALUE_NORMALIZERS), so reordering values changes
+    nothing. Values of RESPELLABLE attributes whose case or spacing changed
+    differ too, though the server takes both spellings as equal. A changed
+    attribute gets MOD_DELETE and MOD_ADD of just the values that differ, or
+    MOD_REPLACE if none of its old values is kept.
+    '''
+    old = _attr_values(old)
+    new = _attr_values(new)
+    modlist = []
+    for key in sorted(set(old) | set(new)):
+        attr, oldv = old.get(key, (None, {}))
+        attr, newv = new.get(key, (attr, {}))
+        # OMITTED is never sent; where kept, the values it stands for stay
+        # and only new ones are added
+        if OMITTED in newv:
+            del newv[OMITTED]
+            oldv.pop(OMITTED, None)
+        if not oldv:
+            if newv:
+                modlist.append((ldap.MOD_ADD, attr, newv.values()))
+        elif not newv:
+            modlist.append((ldap.MOD_DELETE, attr, None))
+        else:
+            if key in RESPELLABLE:
+                removed = [v for k, v in oldv.iteritems()
+                           if newv.get(k) != v]
+                added = [v for k, v in newv.iteritems() if oldv.get(k) != v]
+            else:
+                removed = [v for k, v in oldv.iteritems() if k not in newv]
+                added = [v for k, v in newv.iteritems() if k not in oldv]
+            if len(removed) == len(oldv):
+                modlist.append((ldap.MOD_REPLACE, attr, newv.values()))
+                continue
+            if removed:
+                modlist.append((ldap.MOD_DELETE, attr, removed))
+            if added:
+                modlist.append((ldap.MOD_ADD, attr, added))
+    return modlist
+
+
+Changes = namedtuple('Changes', 'add modify delete rename')
+
+
+def split_dn(dn):
+    '''
+    Return the RDN and the parent DN of dn.
+    '''
+    rdns = ldap.dn.str2dn(dn)
+    return ldap.dn.dn2str(rdns[:1]), ldap.dn.dn2str(rdns[1:])
+
+
+def renamed_dn(dn, newrdn, newsuperior=None):
+    '''
+    Return the DN of the entry at dn once renamed with conn.rename.
     '''
-    Generate add, modify and delete modlists by diffing two LDAP entry lists.
+    if newsuperior is None:
+        newsuperior = split_dn(dn)[1]
+    return newsuperior and '%s,%s' % (newrdn, newsuperior) or newrdn
 
-    Return a dict keyed 'add', 'modify' and 'delete'. The values are lists of
-    tuples - (dn, modlist) for 'add' and 'modify', (dn,) for 'delete',
-    suitable to be passed as arguments to conn.add_s, conn.modify_s and
-    conn.delete_s respectively, where conn is an instance of
-    ldap.ldapobject.LDAPObject.
+
+def _rdn_values(dn):
+    '''
+    Return the (lowercased type, normalized value) pairs of the RDN of dn.
+    '''
+    pairs = []
+    for attr, value, flags in ldap.dn.str2dn(dn)[0]:
+        norm = VALUE_NORMALIZERS.get(attr.lower())
+        pairs.append((attr.lower(), norm(value) if norm else value))
+    return pairs
+
+
+def renamed_entry(entry, dn, newdn):
+    '''
+    Return entry as renaming it from dn to newdn leaves it: without the
+    values of the old RDN and with those of the new one.
     '''
-    changes = Changes([], [], [])
+    attrs = _attr_values(entry)
+    for key, value in _rdn_values(dn):
+        attrs.get(key, (key, {}))[1].pop(value, None)
+    for (key, value), (attr, raw, flags) in zip(
+            _rdn_values(newdn), ldap.dn.str2dn(newdn)[0]):
+        attrs.setdefault(key, (attr, OrderedDict()))[1].setdefault(value, raw)
+    return dict((attr, vmap.values())
+                for attr, vmap in attrs.itervalues() if vmap)
+
+
+def _signature(dn, entry):
+    # What a rename keeps of an entry and tells it from others, as (type,
+    # normalized value) pairs
+    pairs = set()
+    for attr, values in entry.items():
+        key = attr.lower()
+        if key == 'objectclass':
+            continue
+        norm = VALUE_NORMALIZERS.get(key)
+        pairs.update((key, norm(v) if norm else v) for v in values if v)
+    pairs.difference_update(_rdn_values(dn))
+    return pairs
+
+
+def _classes(entry):
+    return frozenset(_normalize(v) for attr, values in entry.items()
+                     if attr.lower() == 'objectclass' for v in values)
+
+
+def find_renames(old, new, deleted, added):
+    '''
+    Pair DNs of deleted, only found in old, with DNs of added, only found in
+    new, whose entries look like the same ones renamed: of the same object
+    classes and sharing at least RENAME_SIMILARITY of their values besides
+    those of the RDN. Values more than RENAME_FANOUT entries have are left
+    out, and so are entries with no other values. Return a list of (dn,
+    newdn) tuples, parents first.
+
+    Renaming moves a whole subtree, so entries of deleted under a DN
+    renamed are left to mkchanges, and a DN is never renamed if entries
+    under it are kept in new.
+    '''
+    if not (deleted and added):
+        return []
+    # Ancestors of entries kept, which must stay where they are
+    kept = set()
+    for dn in old:
+        if dn in new:
+            key = dn_key(dn)
+            kept.update(key[:i] for i in xrange(len(key)))
+    signatures = {}
+    index = {}
+    for dn in added:
+        try:
+            signatures[dn] = _signature(dn, new[dn])
+        except ldap.DECODING_ERROR:
+            continue
+        for pair in signatures[dn]:
+            index.setdefault(pair, []).append(dn)
+    mine = {}
+    for dn in deleted:
+        if dn_key(dn) not in kept:
+            try:
+                mine[dn] = _signature(dn, old[dn])
+            except ldap.DECODING_ERROR:
+                continue
+
+    # How many entries have each value of those deleted, counting all of
+    # old since a single edit shows too few entries to tell
+    counts = {}
+    for pairs in mine.itervalues():
+        counts.update(dict.fromkeys(pairs, 0))
+    keys = set(key for key, value in counts)
+    for entry in old.itervalues():
+        for attr, values in entry.items():
+            key = attr.lower()
+            if key in keys:
+                norm = VALUE_NORMALIZERS.get(key)
+                for v in set(norm(v) if norm else v for v in values):
+                    if (key, v) in counts:
+                        counts[key, v] += 1
+
+    def telling(pairs):
+        return set(p for p in pairs if counts.get(p, 0) +
+                   len(index.get(p, ())) <= RENAME_FANOUT)
+
+    for dn in signatures:
+        signatures[dn] = telling(signatures[dn])
+
+    renames = []
+    moved = {}
+    # New DNs of the entries renamed; what is under them moves along
+    taken = {}
+    for dn in sorted(mine, key=dn_key):
+        key = dn_key(dn)
+        if _nearest(key, moved) is not None:
+            continue
+        pairs = telling(mine[dn])
+        if not pairs:
+            continue
+        classes = _classes(old[dn])
+        shared = {}
+        for pair in pairs:
+            for other in index.get(pair, ()):
+                shared[other] = shared.get(other, 0) + 1
+        best, score = None, RENAME_SIMILARITY
+        for other, n in shared.iteritems():
+            similarity = float(n) / len(pairs | signatures[other])
+            if similarity >= score and classes == _classes(new[other]):
+                other_key = dn_key(other)
+                if other_key not in taken and \
+                        _nearest(other_key, taken) is None:
+                    best, score = other, similarity
+        if best is not None:
+            renames.append((dn, best))
+            moved[key] = dn
+            taken[dn_key(best)] = best
+    return renames
+
+
+def mkchanges(old, new):
+    '''
+    Generate add, modify, delete and rename operations by diffing two LDAP
+    entry lists. Modlists are computed with modify_modlist, so entries that
+    only differ in the order of values are left alone.
+
+    Return a Changes tuple of lists: (dn, modlist) tuples for add and
+    modify, (dn,) for delete and (dn, newrdn, newsuperior) for rename,
+    suitable to be passed as arguments to the add_s, modify_s, delete_s and
+    rename_s methods of ldap.ldapobject.LDAPObject respectively.
+
+    Entries deleted and added that find_renames pairs are renamed instead,
+    moving their subtrees along; entries of the subtree that are found under
+    the new DN are modified there if need be, and the others deleted there.
+    Modifications of renamed entries apply to their new DNs.
+    '''
+    changes = Changes([], [], [], [])
+    added = []
     for dn in new.keys():
         if dn in old:
-            if old[dn] == new[dn]:
+            # Entries reused by parse_ldif are the very same objects
+            if new[dn] is old[dn] or old[dn] == new[dn]:
                 continue
-            modlist = ldap.modlist.modifyModlist(old[dn], new[dn])
-            changes.modify.append((dn, modlist))
+            modlist = modify_modlist(old[dn], new[dn])
+            if modlist:
+                changes.modify.append((dn, modlist))
         else:
-            modlist = ldap.modlist.addModlist(new[dn])
-            changes.add.append((dn, modlist))
-
-    for dn in old.keys():
-        if dn not in new:
-            changes.delete.append((dn,))
-    # Abuse sort_entries since we also happen to have dn at changes[x][0]...
-    sort_entries(changes.add)
-    sort_entries(changes.delete, reverse=True)
+            added.append(dn)
+    deleted = [dn for dn in old.keys() if dn not in new]
+
+    renames = find_renames(old, new, deleted, added)
+    if renames:
+        added = set(added)
+        deleted = set(deleted)
+        added_keys = dict((dn_key(dn), dn) for dn in added)
+        moved = {}
+        for dn, newdn in renames:
+            newrdn, parent = split_dn(newdn)
+            newsuperior = None
+            if dn_key(parent) != dn_key(dn)[:-1]:
+                newsuperior = parent
+            changes.rename.append((dn, newrdn, newsuperior))
+            modlist = modify_modlist(renamed_entry(old[dn], dn, newdn),
+                                     new[newdn])
+            if modlist:
+                changes.modify.append((newdn, modlist))
+            deleted.remove(dn)
+            added.remove(newdn)
+            moved[dn_key(dn)] = dn, newdn
+        for dn in list(deleted):
+            key = dn_key(dn)
+            found = _nearest(key, moved)
+            if found is None:
+                continue
+            # Where the entry is once its ancestor is renamed
+            top, newtop = found
+            rdns = ldap.dn.str2dn(dn)
+            newdn = ldap.dn.dn2str(
+                rdns[:len(rdns) - len(ldap.dn.str2dn(top))]) + ',' + newtop
+            deleted.remove(dn)
+            newdn = added_keys.get(dn_key(newdn), newdn)
+            if newdn in added:
+                added.remove(newdn)
+                if old[dn] == new[newdn]:
+                    continue
+                modlist = modify_modlist(old[dn], new[newdn])
+                if modlist:
+                    changes.modify.append((newdn, modlist))
+            else:
+                changes.delete.append((newdn,))
+        # Keep the order of new and old
+        added = [dn for dn in new.keys() if dn in added]
+        deleted = [dn for dn in old.keys() if dn in deleted]
+
+    for dn in added:
+        modlist = [(attr, [v for v in values if v != OMITTED])
+                   for attr, values in ldap.modlist.addModlist(new[dn])]
+        changes.add.append((dn, [m for m in modlist if m[1]]))
+    changes.delete.extend((dn,) for dn in deleted)
+    # Abuse topo_sort_entries since we also happen to have dn at
+    # changes[x][0]...
+    changes.add[:] = topo_sort_entries(changes.add)
+    changes.delete[:] = topo_sort_entries(changes.delete, reverse=True)
     return changes
 
 
-def connect(uri, binddn, bindpw, starttls=True):
+def _nearest(key, index):
+    '''
+    Return the value in index of the nearest proper ancestor of DN key, or
+    None if there is none.
+    '''
+    key = key[:-1]
+    while key:
+        if key in index:
+            return index[key]
+        key = key[:-1]
+    return index.get(key)
+
+
+def change_ops(changes):
+    '''
+    Flatten changes into a list of (op, change) tuples, in an order that
+    is safe to apply sequentially.
+    '''
+    # Renames may go under added entries and entries be added under renamed
+    # ones; either way, parents first
+    arrivals = topo_sort_entries(
+        [(c[0], 'add', c) for c in changes.add] +
+        [(renamed_dn(*c), 'rename', c) for c in changes.rename])
+    return ([(op, c) for dn, op, c in arrivals] +
+            [('modify', c) for c in changes.modify] +
+            [('delete', c) for c in changes.delete])
+
+
+def _references(modlist, mods=(ldap.MOD_ADD, ldap.MOD_REPLACE)):
+    '''
+    Yield the keys of the DNs that the modifications of a modlist of types
+    in mods give DN-valued attributes, or take from them.
+    '''
+    for mod, attr, values in modlist:
+        if mod in mods and VALUE_NORMALIZERS.get(attr.lower()) is dn_key:
+            for v in values or ():
+                try:
+                    yield dn_key(v)
+                except ldap.DECODING_ERROR:
+                    # Not a DN; the server will say so
+                    pass
+
+
+def _reaches(dependents, start, goal):
+    '''
+    Tell whether goal depends on start, directly or not.
+    '''
+    seen = set([start])
+    stack = [start]
+    while stack:
+        for i in dependents.get(stack.pop(), ()):
+            if i == goal:
+                return True
+            if i not in seen:
+                seen.add(i)
+                stack.append(i)
+    return False
+
+
+def apply_changes(conn, changes, window=DEFAULT_WINDOW,
+                  timings=NULL_TIMINGS, journal=None, controls=None):
+    '''
+    Apply changes as returned by mkchanges over conn, keeping up to window
+    asynchronous operations in flight. The number and latencies of the
+    operations are recorded in timings, and if given an
+    ldapjournal.Journal, each operation is recorded there before it is
+    issued and once it is acknowledged. controls may map DNs to lists of
+    server controls to send with the operations on them.
+
+    An add or rename is only issued after the add or rename bringing its
+    nearest ancestor in place has been acknowledged, and a delete or rename
+    after the deletes and renames of its descendants. A modify waits for
+    the rename of its entry, and for the adds and renames bringing in the
+    DNs it gives DN-valued attributes such as member, which servers
+    enforcing referential integrity check; a delete or rename waits in
+    turn for the modifies mentioning the DN it leaves, such as one taking
+    it out of a group, unless they already wait for it. Everything else is
+    issued as soon as the window allows.
+    Results are collected in the order operations were issued.
+
+    On the first failure no more operations are issued; those in flight are
+    waited for and ApplyError is raised. Return the list of (op, change)
+    tuples completed, in order of completion.
+    '''
+    ops = change_ops(changes)
+    issue = {'add': conn.add_ext, 'modify': conn.modify_ext,
+             'delete': conn.delete_ext, 'rename': conn.rename}
+
+    # Build the dependency graph. Entries arrive at a DN by add or rename,
+    # and depart from one by delete or rename.
+    keys = [dn_key(change[0]) for op, change in ops]
+    arrivals = {}
+    departures = {}
+    for i, (op, change) in enumerate(ops):
+        if op == 'add':
+            arrivals[keys[i]] = i
+        elif op == 'rename':
+            arrivals[dn_key(renamed_dn(*change))] = i
+        if op in ('delete', 'rename'):
+            departures[keys[i]] = i
+    pending = [0] * len(ops)
+    dependents = {}
+
+    def depend(before, after):
+        if before is not None and after is not None and before != after:
+            pending[after] += 1
+            dependents.setdefault(before, []).append(after)
+
+    for i, (op, change) in enumerate(ops):
+        # After the arrival of the nearest ancestor, or of the entry itself
+        # for a modify
+        key = dn_key(renamed_dn(*change)) if op == 'rename' else keys[i]
+        depend(arrivals.get(key) if op == 'modify' and key in arrivals
+               else _nearest(key, arrivals), i)
+        # Before the departure of the nearest ancestor
+        if op in ('delete', 'rename'):
+            depend(i, _nearest(keys[i], departures))
+        # After the arrival of the entries it refers to
+        if op == 'modify':
+            for ref in _references(change[1]):
+                depend(arrivals.get(ref), i)
+    # Departures after the modifies mentioning them, once the rest is in
+    # place, and as long as that makes no cycle
+    for i, (op, change) in enumerate(ops):
+        if op == 'modify':
+            for ref in _references(change[1], (ldap.MOD_ADD, ldap.MOD_DELETE,
+                                               ldap.MOD_REPLACE)):
+                j = departures.get(ref)
+                if j is not None and not _reaches(dependents, j, i):
+                    depend(i, j)
+
+    ready = deque(i for i in xrange(len(ops)) if not pending[i])
+    inflight = deque()
+    done = []
+    failure = None
+    while True:
+        while ready and len(inflight) < window and failure is None:
+            i = ready.popleft()
+            if journal:
+                journal.issued(*ops[i])
+            try:
+                inflight.append((issue[ops[i][0]](
+                    *ops[i][1], serverctrls=(controls or {}).get(
+                        ops[i][1][0])), i, time()))
+                timings.count(ops[i][0] + ' ops')
+            except LDAPError as e:
+                failure = i, e
+        if not inflight:
+            break
+        msgid, i, issued = inflight.popleft()
+        try:
+            conn.result3(msgid)
+        except LDAPError as e:
+            failure = failure or (i, e)
+            continue
+        finally:
+            timings.observe(ops[i][0], time() - issued)
+        done.append(ops[i])
+        if journal:
+            journal.done(*ops[i])
+        for j in dependents.get(i, ()):
+            pending[j] -= 1
+            if not pending[j]:
+                ready.append(j)
+
+    if failure:
+        i, e = failure
+        raise ApplyError(ops[i][0], ops[i][1][0], e, done)
+    return done
+
+
+def root_dse(conn):
+    '''
+    Return the root DSE entry of the server, with the operational
+    attributes advertising supported features.
+    '''
+    results = conn.search_s('', ldap.SCOPE_BASE, '(objectClass=*)',
+                            ['supportedControl', 'supportedExtension'])
+    return results[0][1] if results else {}
+
+
+def _ber_length(n):
+    if n < 0x80:
+        return chr(n)
+    octets = []
+    while n:
+        octets.append(chr(n & 0xff))
+        n >>= 8
+    return chr(0x80 | len(octets)) + ''.join(reversed(octets))
+
+
+def _txn_end_value(txn_id, commit):
+    '''
+    BER-encode txnEndReq ::= SEQUENCE { commit BOOLEAN DEFAULT TRUE,
+    identifier OCTET STRING }.
+    '''
+    body = '' if commit else '\x01\x01\x00'
+    body += '\x04' + _ber_length(len(txn_id)) + txn_id
+    return '\x30' + _ber_length(len(body)) + body
+
+
+def sort_control(attrs):
+    '''
+    Return a Server Side Sort request control (RFC 2891), ordering by the
+    attribute types in attrs. It is not critical, so servers may ignore it.
+    '''
+    keys = ''
+    for attr in attrs:
+        # SortKey ::= SEQUENCE { attributeType AttributeDescription, ... }
+        key = '\x04' + _ber_length(len(attr)) + attr
+        keys += '\x30' + _ber_length(len(key)) + key
+    return RequestControl(SSS_CONTROL, False,
+                          '\x30' + _ber_length(len(keys)) + keys)
+
+
+def _ber_element(data, i=0):
+    '''
+    Return the contents of the BER element at data[i:] and where it ends.
+    '''
+    n = ord(data[i + 1])
+    i += 2
+    if n & 0x80:
+        size = n & 0x7f
+        n = int(data[i:i + size].encode('hex'), 16)
+        i += size
+    return data[i:i + n], i + n
+
+
+class SortResultControl(ResponseControl):
+    '''
+    The Server Side Sort response control (RFC 2891). result is the
+    sortResult code, 0 if the entries were sorted.
+    '''
+    controlType = SSS_RESULT_CONTROL
+
+    def decodeControlValue(self, encodedControlValue):
+        # SortResult ::= SEQUENCE { sortResult ENUMERATED, ... }
+        body, end = _ber_element(encodedControlValue)
+        value, end = _ber_element(body)
+        self.result = int(value.encode('hex'), 16)
+
+
+# python-ldap drops response controls it does not know
+KNOWN_RESPONSE_CONTROLS[SSS_RESULT_CONTROL] = SortResultControl
+
+
+def assertion_control(attr, value):
+    '''
+    Return a critical Assertion control (RFC 4528), making the operation it
+    goes with fail unless the entry has value for attr.
+    '''
+    # equalityMatch [3] AttributeValueAssertion
+    ava = '\x04' + _ber_length(len(attr)) + attr
+    ava += '\x04' + _ber_length(len(value)) + value
+    return RequestControl(ASSERTION_CONTROL, True,
+                          '\xa3' + _ber_length(len(ava)) + ava)
+
+
+def apply_transactions(conn, changes, size=DEFAULT_TXN_SIZE,
+                       timings=NULL_TIMINGS, journal=None, controls=None):
+    '''
+    Apply changes as returned by mkchanges over conn in LDAP transactions
+    (RFC 5805) of up to size operations each, committed one after another.
+
+    The operations of a transaction are all sent before it is committed,
+    since the server may hold back their responses until then. If a
+    transaction fails to commit, none of its operations take effect and
+    ApplyError is raised. Return the list of (op, change) tuples
+    completed. The operations and commit latencies are recorded in timings,
+    and the operations in journal if given; controls are sent as with
+    apply_changes.
+    '''
+    ops = change_ops(changes)
+    issue = {'add': conn.add_ext, 'modify': conn.modify_ext,
+             'delete': conn.delete_ext, 'rename': conn.rename}
+    done = []
+    for start in xrange(0, len(ops), size):
+        batch = ops[start:start + size]
+        what = 'transaction of %d operation(s)' % len(batch)
+        try:
+            txn_id = conn.extop_s(ExtendedRequest(TXN_START, None))[1]
+        except LDAPError as e:
+            raise ApplyError('start', what, e, done)
+        spec = [RequestControl(TXN_SPEC, True, txn_id)]
+        msgids = []
+        try:
+            for op, change in batch:
+                if journal:
+                    journal.issued(op, change)
+                msgids.append(issue[op](*change, serverctrls=spec + (
+                    controls or {}).get(change[0], [])))
+                timings.count(op + ' ops')
+            t = time()
+            conn.extop_s(ExtendedRequest(TXN_END,
+                                         _txn_end_value(txn_id, True)))
+            timings.observe('commit', time() - t)
+        except LDAPError as e:
+            try:
+                conn.extop_s(ExtendedRequest(TXN_END,
+                                             _txn_end_value(txn_id, False)))
+            except LDAPError:
+                # Already settled by the failed commit
+                pass
+            raise ApplyError('commit', what, e, done)
+        finally:
+            # The outcome is that of the commit; do not wait for the
+            # responses to the individual operations
+            for msgid in msgids:
+                conn.abandon(msgid)
+        done.extend(batch)
+        if journal:
+            for op, change in batch:
+                journal.done(op, change)
+    return done
+
+
+def connect(uri, binddn, bindpw, starttls=True, timeout=None,
+            timings=NULL_TIMINGS):
     '''
     Perform a combo of LDAP initialization and binding and return the
     connection.
+
+    If timeout is given, connecting, StartTLS and binding each fail with
+    ldap.TIMEOUT or ldap.SERVER_DOWN after that many seconds instead of the
+    TCP timeout of the OS.
     '''
     conn = ldap.initialize(uri)
+    if timeout:
+        # The TCP connect and TLS handshake, the StartTLS exchange, and the
+        # bind respectively
+        conn.set_option(ldap.OPT_NETWORK_TIMEOUT, timeout)
+        conn.set_option(ldap.OPT_TIMEOUT, timeout)
+        conn.timeout = timeout
     if starttls:
         # XXX
         ldap.set_option(ldap.OPT_X_TLS_REQUIRE_CERT, ldap.OPT_X_TLS_NEVER)
-        conn.start_tls_s()
-    conn.bind_s(binddn, bindpw)
+        with timings.phase('starttls'):
+            conn.start_tls_s()
+    with timings.phase('bind'):
+        conn.bind_s(binddn, bindpw)
+    # Only bound the handshake; searches may legitimately take long
+    if timeout:
+        conn.set_option(ldap.OPT_TIMEOUT, -1)
+    conn.timeout = -1
     return conn
 
 
+def connect_fastest(uris, binddn, bindpw, starttls=True,
+                    timeout=DEFAULT_TIMEOUT, stagger=DEFAULT_STAGGER,
+                    latencies=None):
+    '''
+    Race connections to uris, which should be ordered by preference, and
+    return (uri, conn) for the first one to complete StartTLS and bind.
+
+    The attempts are started stagger seconds apart, each bounded by timeout
+    for connecting, StartTLS and binding; if none completes in that time,
+    raise ldap.TIMEOUT. The losers are unbound when they complete. If
+    latencies is a dict, the time each attempt took is stored in it keyed by
+    uri (timeout for failed ones); attempts still running on return store
+    it later. If all attempts fail, raise the error of the last one.
+    '''
+    results = Queue()
+
+    def attempt(uri, delay):
+        sleep(delay)
+        t = time()
+        try:
+            conn = connect(uri, binddn, bindpw, starttls, timeout)
+        except Exception as e:
+            # Reported all the same, or the race would wait for it
+            conn = e
+        if latencies is not None:
+            latencies[uri] = time() - t if not isinstance(conn, Exception) \
+                else timeout
+        results.put((uri, conn))
+
+    for i, uri in enumerate(uris):
+        thread = threading.Thread(target=attempt, args=(uri, i * stagger))
+        thread.daemon = True
+        thread.start()
+
+    def discard(n):
+        for i in xrange(n):
+            loser = results.get()[1]
+            if not isinstance(loser, Exception):
+                loser.unbind_s()
+
+    deadline = timeout and \
+        time() + (len(uris) - 1) * stagger + 3 * timeout + 1
+    received = 0
+    while True:
+        try:
+            # Bounded get, so that ^C still works
+            uri, conn = results.get(timeout=1)
+        except Empty:
+            if deadline and time() > deadline:
+                conn = ldap.TIMEOUT({'desc': 'Timed out connecting to %s' %
+                                     ' or '.join(uris)})
+                break
+            continue
+        received += 1
+        if not isinstance(conn, Exception) or received == len(uris):
+            break
+
+    thread = threading.Thread(target=discard, args=(len(uris) - received,))
+    thread.daemon = True
+    thread.start()
+    if isinstance(conn, Exception):
+        raise conn
+    return uri, conn
+
+
 def ask(prompt, candidates, default=None):
     '''
     Ask the user to choose from a list of candidates, ignoring cases of user
@@ -252,75 +1811,482 @@ class ActionError(Exception):
         return self.message
 
 
+class ApplyError(ActionError):
+    '''
+    An ActionError from applying changes, recording the operations that
+    completed before the failure in the done attribute.
+    '''
+    def __init__(self, op, dn, e, done):
+        ActionError.__init__(self, 'operate', ' to %s %s' % (op, dn), e)
+        self.done = done
+        self.message += '\n%d operation(s) completed before the failure%s' % (
+            len(done), done and ':' or '.')
+        for op, change in done:
+            self.message += '\n    %s %s' % (op, change[0])
+
+
 class Action(object):
+    # Options, overridable by keyword arguments to start()
+    pagesize = DEFAULT_PAGESIZE
+    sort = False
+    window = DEFAULT_WINDOW
+    agent = True
+    cache = False
+    timeout = DEFAULT_TIMEOUT
+    # Use transactions of this many operations if the server supports them
+    txn_size = 0
+    # Apply without asking for confirmation
+    assume_yes = False
+    # Only show what would be done
+    dry_run = False
+    # Let the user edit the LDIF of New before applying it
+    edit = True
+    # Dict to record connection latencies in, see connect_fastest
+    latencies = None
+    # Where to record phases and counters, see Timings
+    timings = NULL_TIMINGS
+    # Attributes to request, None for all user attributes
+    attrlist = None
+    # Request attribute types only, without values
+    attrs_only = False
+    # Attribute for the server to sort one-level searches by, if it can
+    sort_key = None
+    # With several bases, output entries as they arrive instead of base by
+    # base
+    interleave = False
+    # Leave the values of BINARY_ATTRS out of searches, see OMITTED
+    omit_binary = False
+    # Let Edit write large and binary values to sidecar files
+    sidecars = True
+    # Worker processes for writing and parsing PARALLEL_MIN entries or more;
+    # None for as many as there are CPUs, 1 to never fork
+    jobs = None
+    # Path of the ldapsnap snapshot written by Snapshot and read by Query
+    snapshot = None
+    # Function Report passes an iterable of (dn, entry) tuples found to
+    report = None
+    # Path of the journal of operations kept while applying, see ldapjournal
+    journal = None
+    # Let Apply delete entries in scope missing from the LDIF, searching the
+    # whole scope; otherwise only the entries in the LDIF are looked up
+    delete = False
+    # Guard the modifies and deletes of Apply with Assertion controls on the
+    # modifyTimestamp of the entries looked up
+    assertions = False
+    # Format Watch writes changes in, 'ldif' or 'json'; see ldapwatch
+    output = 'ldif'
+    # Let Watch report the entries found on its first run, not just changes
+    initial = False
+    # Path of the state of Watch, by default in the cache directory
+    watch_state = None
+
+    # The ldapcache.SearchCache make_entries read from, one per base, if any
+    search_caches = ()
+    # Fingerprints of the records written by write_entries, if recorded
+    fingerprints = None
+    # The root DSE of the server, once read by root_dse
+    _root_dse = None
+    # Where write_entries puts sidecar files, see LDIFWriter
+    sidecar_dir = None
+    # modifyTimestamp of the entries looked up by fetch_entries, by DN, if
+    # recorded
+    stamps = None
+    # Response controls of the last pages of the searches last made by
+    # search_entries
+    responses = None
+
     def __init__(self, **kw):
         self.__dict__.update(kw)
 
     def connect(self):
+        '''
+        Connect to self.uri; if that is a list of URIs, to whichever
+        responds first. self.uri is then set to the URI chosen.
+        '''
+        uris = self.uri if isinstance(self.uri, list) else [self.uri]
+        with self.timings.phase('connect'):
+            self._connect(uris)
+
+    def _connect(self, uris):
         try:
-            self.conn = connect(
-                self.uri, self.binddn, self.bindpw, self.starttls)
+            self.conn = None
+            if self.agent:
+                # Borrow a bound connection from ldapagent when it runs
+                import ldapagent
+                for uri in uris:
+                    try:
+                        self.conn = ldapagent.connect(
+                            uri, self.binddn, self.bindpw, self.starttls)
+                    except (ldap.SERVER_DOWN, ldap.TIMEOUT):
+                        if uri == uris[-1]:
+                            raise
+                        continue
+                    self.uri = uri
+                    break
+            if self.conn is None:
+                if len(uris) == 1:
+                    self.uri = uris[0]
+                    self.conn = connect(self.uri, self.binddn, self.bindpw,
+                                        self.starttls, self.timeout,
+                                        self.timings)
+                else:
+                    self.uri, self.conn = connect_fastest(
+                        uris, self.binddn, self.bindpw, self.starttls,
+                        self.timeout, latencies=self.latencies)
         except LDAPError as e:
             raise ActionError('connect', ' to %s as %s %s' % (
-                self.uri, self.binddn, self.starttls * 'with TLS'), e)
+                ' or '.join(uris), self.binddn, self.starttls * 'with TLS'),
+                e)
 
     def mktemp(self):
         return mktemp('.ldif', 'ldaptuna')
 
-    def make_entries(self):
+    def bases(self):
+        '''
+        Return the list of bases to search; self.base may be a single one.
+        '''
+        return self.base if isinstance(self.base, list) else [self.base]
+
+    def search_error(self, e):
+        return ActionError('search', ' in %s' % ' and '.join(self.bases()), e)
+
+    def search_entries(self, serverctrls=None):
+        '''
+        Yield (dn, entry) tuples of the search as they arrive from the server.
+
+        Several bases are searched at once over the connection. Unless
+        self.interleave is true, entries are yielded base by base anyway,
+        holding back those of a base until the previous ones are complete.
+
+        With self.omit_binary, the values of BINARY_ATTRS are not fetched
+        and appear as OMITTED.
+        '''
+        if not self.omit_binary:
+            return self._search_entries(serverctrls, self.attrlist,
+                                        self.attrs_only)
+        return self._search_omitting_binary(serverctrls)
+
+    def _search_omitting_binary(self, serverctrls):
+        # There is no asking for all attributes but some; find out which
+        # there are first, without their values
+        binary = {}
+        types = OrderedDict()
+        for dn, entry in self._search_entries(serverctrls, self.attrlist,
+                                              True):
+            for attr in entry:
+                key = attr.lower()
+                types.setdefault(key, attr)
+                if key.partition(';')[0] in BINARY_ATTRS:
+                    binary.setdefault(dn, []).append(attr)
+        attrlist = [attr for key, attr in types.iteritems()
+                    if key.partition(';')[0] not in BINARY_ATTRS]
+        # 1.1 asks for no attributes at all
+        for dn, entry in self._search_entries(serverctrls,
+                                              attrlist or ['1.1'],
+                                              self.attrs_only):
+            for attr in binary.get(dn, ()):
+                entry[attr] = [OMITTED]
+            yield dn, entry
+
+    def _search_entries(self, serverctrls, attrlist, attrs_only):
+        bases = self.bases()
+        # Pages held back per base, and whether each base is complete
+        held = [[] for base in bases]
+        complete = [False] * len(bases)
+        current = 0
+        count = self.timings.count
         try:
-            entries = OrderedDict(sort_entries(self.conn.search_s(
-                self.base, SCOPES[self.scope], self.filterstr)))
+            self.responses = []
+            for i, page, done in search_many(
+                    self.conn, bases, SCOPES[self.scope], self.filterstr,
+                    attrlist, self.pagesize, int(attrs_only), serverctrls,
+                    self.responses):
+                if self.timings.enabled:
+                    count('entries received', len(page))
+                    # Payload only; python-ldap does not expose the BER
+                    # size of responses
+                    count('bytes received', sum(
+                        len(dn) + sum(len(v) for values in entry.itervalues()
+                                      for v in values)
+                        for dn, entry in page))
+                complete[i] = done
+                if self.interleave or i == current:
+                    pages = [page]
+                else:
+                    held[i].append(page)
+                    pages = []
+                while not self.interleave and current < len(bases) and \
+                        complete[current]:
+                    current += 1
+                    if current < len(bases):
+                        pages.extend(held[current])
+                        held[current] = None
+                for page in pages:
+                    for dn, entry in page:
+                        yield dn, entry
         except LDAPError as e:
-            raise ActionError('search', ' in %s' % self.base, e)
-        return entries
+            raise self.search_error(e)
 
-    def write_entries(self, stream, entries):
-        writer = LDIFWriter(stream)
-        for dn, attrs in entries.items():
+    def make_entries(self):
+        # The cache holds whole entries, values of BINARY_ATTRS included
+        if self.cache and not self.omit_binary:
+            import ldapcache
+            self.search_caches = [
+                ldapcache.SearchCache(self.uri, self.binddn, base,
+                                      SCOPES[self.scope], self.filterstr)
+                for base in self.bases()]
+            try:
+                with self.timings.phase('search'):
+                    # One at a time; a refresh is mostly round trips for
+                    # the changes since the last one
+                    entries = OrderedDict()
+                    for cache in self.search_caches:
+                        entries.update(cache.refresh(self.conn,
+                                                     self.pagesize))
+            except LDAPError as e:
+                raise self.search_error(e)
+            if len(self.search_caches) == 1:
+                return entries
+            with self.timings.phase('sort'):
+                return OrderedDict(sort_entries(entries.items()))
+        if self.scope == 'one' and self.sort_key and \
+                SSS_CONTROL in self.root_dse().get('supportedControl', []):
+            # Siblings may come in any order; let the server sort them
+            with self.timings.phase('search'):
+                entries = list(compact_entries(self.search_entries(
+                    [sort_control([self.sort_key])])))
+            # Unless it did not, as the control is not critical
+            results = [c.result for c in self.responses
+                       if isinstance(c, SortResultControl)]
+            if results and not any(results):
+                return OrderedDict(entries)
+        else:
+            with self.timings.phase('search'):
+                entries = list(compact_entries(self.search_entries()))
+        with self.timings.phase('sort'):
+            return OrderedDict(sort_entries(entries))
+
+    def in_scope(self, dn):
+        key = dn_key(dn)
+        for base in self.bases():
+            base = dn_key(base)
+            if self.scope == 'base' and key == base or \
+                    self.scope == 'one' and key[:-1] == base or \
+                    self.scope == 'sub' and key[:len(base)] == base:
+                return True
+        return False
+
+    def fetch_entries(self, dns):
+        '''
+        Return an OrderedDict of the entries of the search among dns, looked
+        up one by one. With self.assertions, their modifyTimestamp is kept
+        in self.stamps instead.
+        '''
+        attrlist = self.attrlist
+        if self.assertions:
+            attrlist = (attrlist or ['*']) + ['modifyTimestamp']
+            self.stamps = {}
+        dns = [dn for dn in dns if self.in_scope(dn)]
+        self.timings.count('lookups', len(dns))
+        try:
+            with self.timings.phase('search'):
+                found = []
+                for dn, entry in fetch_entries(self.conn, dns,
+                                               self.filterstr, attrlist,
+                                               self.window):
+                    if self.assertions:
+                        stamp = entry.pop('modifyTimestamp', None)
+                        if stamp:
+                            self.stamps[dn] = stamp[0]
+                    found.append((dn, entry))
+        except LDAPError as e:
+            raise self.search_error(e)
+        return OrderedDict(compact_entries(found))
+
+    def assertion_controls(self, changes):
+        '''
+        Return Assertion controls on the modifyTimestamp of the entries
+        about to be modified or deleted, keyed by DN, or None if there are
+        no stamps or the server does not support them.
+        '''
+        if not self.stamps:
+            return None
+        if ASSERTION_CONTROL not in \
+                self.root_dse().get('supportedControl', []):
+            print('The server does not support assertions, applying '
+                  'without them.')
+            return None
+        return dict((c[0], [assertion_control('modifyTimestamp',
+                                              self.stamps[c[0]])])
+                    for c in changes.modify + changes.delete
+                    if c[0] in self.stamps)
+
+    def check_stale(self, changes):
+        '''
+        Make sure entries about to be modified or deleted have not changed
+        on the server since make_entries read them from the cache.
+        '''
+        if not self.search_caches:
+            return
+        dns = [c[0] for c in
+               changes.modify + changes.delete + changes.rename]
+        try:
+            with self.timings.phase('check stale'):
+                stale = []
+                for cache in self.search_caches:
+                    stale.extend(cache.modified(self.conn, dns,
+                                                self.pagesize))
+        except LDAPError as e:
+            raise self.search_error(e)
+        if stale:
+            raise ActionError(
+                'operate', ' (stale data)',
+                'modified on the server since read, run again to pick up '
+                'the changes:\n    ' + '\n    '.join(stale))
+
+    def write_entries(self, stream, entries, fingerprints=None):
+        '''
+        Write an iterable of (dn, entry) tuples to stream as LDIF. If
+        fingerprints is a dict, record the fingerprint of each record in it;
+        see parse_ldif. Long lists of entries are written by a pool of
+        processes; see pool_size.
+        '''
+        workers = isinstance(entries, list) and \
+            pool_size(self.jobs, len(entries))
+        if workers:
+            i = 0
+            for data, prints in parallel_map(_unparse_chunk, entries,
+                                             workers,
+                                             fingerprints is not None,
+                                             self.sidecar_dir):
+                stream.write(data)
+                if prints is not None:
+                    for p in prints:
+                        fingerprints[p] = entries[i][0]
+                        i += 1
+            return
+        if fingerprints is None:
+            writer = LDIFWriter(stream, sidecar_dir=self.sidecar_dir)
+            for dn, attrs in entries:
+                writer.unparse(dn, attrs)
+            return
+        buf = StringIO()
+        writer = LDIFWriter(buf, sidecar_dir=self.sidecar_dir)
+        for dn, attrs in entries:
             writer.unparse(dn, attrs)
+            record = buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+            # Leave out the line end of the last line and the empty line
+            # separating records, like parse_ldif does
+            fingerprints[fingerprint(record[:-2])] = dn
+            stream.write(record)
 
     def read_apply(self, stream, old):
-        parser = LDIFParser(stream)
-        new = parser.parse()
-        changes = mkchanges(old, new)
+        with self.timings.phase('parse'):
+            new = parse_ldif(stream.read(), old, self.fingerprints,
+                             self.jobs, self.sidecar_dir)
+        self.diff_apply(old, new)
 
-        if not (changes.add or changes.modify or changes.delete):
+    def diff_apply(self, old, new):
+        with self.timings.phase('diff'):
+            changes = mkchanges(old, new)
+
+        if not any(changes):
             print('Nothing changed.')
             return
-
-        msg = 'add %d, modify %d, delete %d. Confirm? [Y/n/q] ' % (
-              len(changes.add), len(changes.modify),
-              len(changes.delete))
-
-        reply = ask(msg, 'ynq', 'y')
-        if reply == 'n':
-            raise UserCancel()
-        elif reply == 'q':
+        self.apply(changes)
+
+    def apply(self, changes, journal=None):
+        '''
+        Confirm and apply changes as returned by mkchanges. Unless given the
+        ldapjournal.Journal of an earlier attempt, start one at self.journal
+        if set and writable; it is removed once everything is applied.
+        '''
+        summary = 'add %d, modify %d, delete %d, rename %d' % (
+            len(changes.add), len(changes.modify), len(changes.delete),
+            len(changes.rename))
+
+        if self.dry_run:
+            for op, change in change_ops(changes):
+                if op == 'rename':
+                    print('rename %s to %s' % (change[0],
+                                               renamed_dn(*change)))
+                else:
+                    print('%s %s' % (op, change[0]))
+            print('%s (dry run, nothing applied).' % summary)
             return
 
-        for op in 'add', 'modify', 'delete':
-            func = getattr(self.conn, '%s_s' % op)
-            for change in getattr(changes, op):
-                try:
-                    func(*change)
-                except ldap.LDAPError as e:
-                    raise ActionError('operate',
-                                      ' to %s %s' % (op, change[0]), e)
+        if not self.assume_yes:
+            with self.timings.phase('confirm'):
+                reply = ask(summary + '. Confirm? [Y/n/q] ', 'ynq', 'y')
+            if reply == 'n':
+                raise UserCancel()
+            elif reply == 'q':
+                return
+
+        self.check_stale(changes)
+        controls = self.assertion_controls(changes)
+        if journal is None and self.journal:
+            import ldapjournal
+            try:
+                journal = ldapjournal.Journal(self.journal, changes)
+            except (IOError, OSError) as e:
+                sys.stderr.write('Not journaling the operations: %s\n' % e)
+        try:
+            with self.timings.phase('apply'):
+                if self.txn_size and TXN_START in \
+                        self.root_dse().get('supportedExtension', []):
+                    apply_transactions(self.conn, changes, self.txn_size,
+                                       self.timings, journal, controls)
+                else:
+                    apply_changes(self.conn, changes, self.window,
+                                  self.timings, journal, controls)
+        except ApplyError as e:
+            if journal:
+                e.message += '\nResume with apply --resume; the operations ' \
+                    'are journaled in %s' % journal.path
+            raise
+        finally:
+            if journal:
+                journal.close()
+        if journal:
+            journal.remove()
+
+    def root_dse(self):
+        '''
+        Return the root DSE of the server, read once per action.
+        '''
+        if self._root_dse is None:
+            try:
+                self._root_dse = root_dse(self.conn)
+            except LDAPError:
+                # Some servers hide the root DSE; assume it advertises
+                # nothing
+                self._root_dse = {}
+        return self._root_dse
 
     def edit_read_apply(self, fname, old):
-        fire_editor(fname)
+        import ldapjournal
+        with self.timings.phase('editor'):
+            fire_editor(fname)
+        self.journal = ldapjournal.journal_path(fname)
         stream = open(fname)
         try:
             self.read_apply(stream, old)
         except:
             print('LDIF draft saved in %s' % fname)
+            if self.sidecar_dir and os.path.isdir(self.sidecar_dir):
+                print('with values too large for it in %s' %
+                      self.sidecar_dir)
             raise
         finally:
             stream.close()
 
         os.unlink(fname)
         print('Removed %s.' % fname)
+        if self.sidecar_dir and os.path.isdir(self.sidecar_dir):
+            shutil.rmtree(self.sidecar_dir)
 
     def work(self, base, scope, filterstr, ldif):
         raise NotImplementedError
@@ -331,6 +2297,7 @@ actions = {}
 
 def register(cls):
     actions[cls.cmd] = cls
+    return cls
 
 
 @register
@@ -338,8 +2305,48 @@ class Apply(Action):
     cmd = 'apply'
 
     def work(self):
-        old = self.make_entries()
-        self.read_apply(StringIO(self.ldif), old)
+        if self.delete:
+            old = self.make_entries()
+            self.read_apply(StringIO(self.ldif), old)
+            return
+        # Entries missing from the LDIF are left alone, so only those in it
+        # need looking up
+        with self.timings.phase('parse'):
+            new = parse_ldif(self.ldif, jobs=self.jobs)
+        self.diff_apply(self.fetch_entries(new.keys()), new)
+
+
+@register
+class Resume(Action):
+    '''
+    Finish applying changes interrupted by a failure, from the journal
+    option, without searching again.
+    '''
+    cmd = 'resume'
+
+    def work(self):
+        import ldapjournal
+        try:
+            journal = ldapjournal.Journal(self.journal)
+        except (IOError, ValueError) as e:
+            raise ActionError('resume', ' from %s' % self.journal, e)
+        try:
+            try:
+                with self.timings.phase('verify'):
+                    settled = journal.settle(self.conn)
+            except LDAPError as e:
+                raise ActionError('verify', ' the operations in flight', e)
+            changes = journal.remaining()
+            print('%d operation(s) done already, %d of them found applied '
+                  'on the server.' % (len(journal.acknowledged), settled))
+            if not any(changes):
+                journal.close()
+                journal.remove()
+                print('Nothing left to apply.')
+                return
+            self.apply(changes, journal)
+        finally:
+            journal.close()
 
 
 @register
@@ -347,8 +2354,32 @@ class List(Action):
     cmd = 'list'
 
     def work(self):
-        entries = self.make_entries()
-        self.write_entries(sys.stdout, entries)
+        if self.attrs_only:
+            # LDIF has no notation for attribute types alone; write them
+            # with empty values like ldapsearch -A
+            def convert(entry):
+                return dict.fromkeys(entry, [''])
+        else:
+            def convert(entry):
+                return entry
+        if self.sort or self.cache:
+            entries = self.make_entries().iteritems()
+            if self.search_caches and \
+                    (self.attrlist is not None or self.attrs_only):
+                # The cache holds whole entries
+                entries = [(dn, convert(project(entry, self.attrlist,
+                                                self.attrs_only)))
+                           for dn, entry in entries]
+            else:
+                entries = [(dn, convert(entry)) for dn, entry in entries]
+            phase = 'write'
+        else:
+            # Stream entries in server order, one page at a time
+            entries = ((dn, convert(entry))
+                       for dn, entry in self.search_entries())
+            phase = 'search and write'
+        with self.timings.phase(phase):
+            self.write_entries(sys.stdout, entries)
 
 
 @register
@@ -359,17 +2390,141 @@ class Edit(Action):
         old = self.make_entries()
 
         stream, fname = self.mktemp()
-        self.write_entries(stream, old)
+        if self.sidecars:
+            # Next to the draft, created on first use
+            self.sidecar_dir = os.path.splitext(fname)[0] + '.d'
+        self.fingerprints = {}
+        with self.timings.phase('write'):
+            self.write_entries(stream, old.items(), self.fingerprints)
         stream.close()
 
         self.edit_read_apply(fname, old)
 
 
+@register
+class Report(Action):
+    '''
+    Hand the entries found to the report option instead of writing them.
+    '''
+    cmd = 'report'
+
+    def work(self):
+        if self.cache:
+            entries = self.make_entries().iteritems()
+        else:
+            # Nothing to sort; let report consume entries as they arrive
+            entries = self.search_entries()
+        with self.timings.phase('report'):
+            self.report(entries)
+
+
+@register
+class Snapshot(Action):
+    cmd = 'snapshot'
+
+    def work(self):
+        import ldapsnap
+        self.attrlist = ['*']
+        try:
+            with self.timings.phase('search and write'):
+                n = ldapsnap.write(self.snapshot, self.search_entries(),
+                                   base=self.base, uri=self.uri,
+                                   binddn=self.binddn)
+        except (IOError, OSError, ldapsnap.sqlite3.Error) as e:
+            raise ActionError('write', ' snapshot %s' % self.snapshot, e)
+        print('Saved %d entries to %s.' % (n, self.snapshot))
+
+
+@register
+class Query(List):
+    '''
+    Like List, but search an ldapsnap snapshot instead of the server.
+    '''
+    cmd = 'query'
+    cache = False
+
+    def connect(self):
+        import ldapsnap
+        try:
+            self.conn = ldapsnap.Snapshot(self.snapshot)
+        except (IOError, ldapsnap.sqlite3.Error) as e:
+            raise ActionError('open', ' snapshot %s' % self.snapshot, e)
+
+    def root_dse(self):
+        return {}
+
+    def search_entries(self, serverctrls=None):
+        try:
+            for base in self.bases():
+                for dn, entry in self.conn.search(base, SCOPES[self.scope],
+                                                  self.filterstr):
+                    # As requested from the server
+                    yield dn, project(entry, self.attrlist, self.attrs_only)
+        except (LDAPError, ValueError) as e:
+            raise self.search_error(e)
+
+
+@register
+class Watch(Action):
+    '''
+    Write changes to the entries of the search to stdout as they happen,
+    until interrupted; see ldapwatch.
+    '''
+    cmd = 'watch'
+
+    def connect(self):
+        # The search never ends, which would hold up a connection of
+        # ldapagent
+        self.agent = False
+        Action.connect(self)
+
+    def work(self):
+        try:
+            import ldapwatch
+        except ImportError as e:
+            raise ActionError('watch', ' (python-ldap lacks syncrepl)', e)
+        path = self.watch_state or ldapwatch.state_path(
+            self.uri, self.binddn, self.base, SCOPES[self.scope],
+            self.filterstr)
+        consumer = ldapwatch.Consumer(
+            path, ldapwatch.FORMATS[self.output](sys.stdout), self.initial)
+        try:
+            while True:
+                try:
+                    consumer.watch(self.conn, self.base, SCOPES[self.scope],
+                                   self.filterstr, self.attrlist)
+                    # The server ended the search
+                    return
+                except ldap.SERVER_DOWN as e:
+                    sys.stderr.write('Lost connection to %s: %s\n' % (
+                        self.uri, e))
+                self.reconnect()
+        except LDAPError as e:
+            raise ActionError('watch', ' %s' % self.base, e)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            consumer.close()
+
+    def reconnect(self):
+        # Resuming from the cookie saved, which makes it cheap
+        while True:
+            sleep(WATCH_RETRY)
+            try:
+                self._connect([self.uri])
+                return
+            except ActionError as e:
+                sys.stderr.write('%s\n' % e)
+
+
 @register
 class New(Action):
     cmd = 'new'
 
     def work(self):
+        if not self.edit:
+            self.read_apply(StringIO(self.ldif), OrderedDict())
+            return
         stream, fname = self.mktemp()
         stream.write(self.ldif)
         stream.close()
@@ -377,23 +2532,45 @@ class New(Action):
         self.edit_read_apply(fname, OrderedDict())
 
 
+def _positive_int(s):
+    '''
+    Convert an option value to an int, refusing values below 1.
+    '''
+    n = int(s)
+    if n < 1:
+        raise ArgumentTypeError('must be at least 1: %r' % s)
+    return n
+
+
 def start(uri, binddn, bindpw, starttls=True,
           base='', scope='sub', filterstr='',
-          action='edit', ldif=''):
+          action='edit', ldif='', **options):
     '''
     Entrance point of ldapvi.
 
-    action is one of 'apply', 'edit', 'list' and 'new'.
+    action is one of 'apply', 'edit', 'list', 'new', 'report', 'resume',
+    'snapshot', 'query' and 'watch'. 'report' calls the report option with
+    the entries found; 'resume' finishes an interrupted apply from the
+    journal option; 'snapshot' and 'query' save and search the snapshot
+    option; 'watch' writes changes as they happen. uri may be a
+    list, in which case the fastest server to respond is used. Extra keyword
+    arguments override the options defined as class attributes of Action,
+    e.g. pagesize, sort, window, agent, cache, timeout, txn_size, assume_yes,
+    dry_run, edit, timings, attrlist, attrs_only, sort_key, interleave,
+    omit_binary, sidecars, jobs, snapshot, report, journal, delete,
+    assertions, output, initial and watch_state.
     '''
     filterstr = filterstr or '(objectClass=*)'
 
     actor = actions[action](uri=uri, binddn=binddn, bindpw=bindpw,
                             starttls=starttls, base=base, scope=scope,
-                            filterstr=filterstr, action=action, ldif=ldif)
+                            filterstr=filterstr, action=action, ldif=ldif,
+                            **options)
 
     try:
-        actor.connect()
-        actor.work()
+        with actor.timings.phase('total'):
+            actor.connect()
+            actor.work()
     except ActionError as e:
         print(str(e))
         return e.what
@@ -426,6 +2603,32 @@ def main():
         parser.add_argument(*t, action='store_true', default=False)
     parser.add_argument('-s', '--scope', type=str,
                         choices=SCOPES.keys(), default='sub')
+    parser.add_argument('--pagesize', type=int, default=DEFAULT_PAGESIZE,
+                        help='entries per page of search results, 0 to '
+                        'disable paging')
+    parser.add_argument('--window', type=_positive_int,
+                        default=DEFAULT_WINDOW,
+                        help='maximum number of write operations in flight')
+    parser.add_argument('--no-agent', dest='agent', action='store_false',
+                        default=True, help='do not use a running ldapagent')
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT,
+                        help='seconds to wait for the server to connect '
+                        'and bind')
+    parser.add_argument('--cache', action='store_true', default=False,
+                        help='serve the search from a local cache, '
+                        'refreshed incrementally')
+    parser.add_argument('--omit-binary', action='store_true', default=False,
+                        help='do not fetch photos and certificates')
+    parser.add_argument('--no-sidecars', dest='sidecars',
+                        action='store_false', default=True,
+                        help='write large and binary values inline')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='processes writing and parsing large LDIF, '
+                        'default one per CPU')
+    parser.add_argument('--timings', action='store_true', default=False,
+                        help='print time spent per phase to stderr')
+    parser.add_argument('--timings-json', metavar='FILE',
+                        help='write time spent per phase as JSON to FILE')
     parser.add_argument('filterstr', nargs='?', default='')
 
     args = parser.parse_args()
@@ -437,8 +2640,16 @@ def main():
     if args.askpw:
         args.bindpw = getpass()
 
-    exit(start(args.uri, args.binddn, args.bindpw, args.starttls,
-               args.base, args.scope, args.filterstr))
+    timings = Timings() if args.timings or args.timings_json \
+        else NULL_TIMINGS
+    why = start(args.uri, args.binddn, args.bindpw, args.starttls,
+                args.base, args.scope, args.filterstr,
+                pagesize=args.pagesize, window=args.window,
+                agent=args.agent, cache=args.cache, timeout=args.timeout,
+                timings=timings, omit_binary=args.omit_binary,
+                sidecars=args.sidecars, jobs=args.jobs)
+    report_timings(timings, args.timings, args.timings_json)
+    exit(why)
 
 
 if __name__ == '__main__':
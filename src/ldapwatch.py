@@ -0,0 +1,211 @@
+'''
+Stream the changes to a subtree as they happen, with the Content
+Synchronization Operation (syncrepl, RFC 4533) in refreshAndPersist mode.
+
+One search stays open and the server sends each change as it is made, so
+the cost is per change rather than per poll. The sync cookie and the DN of
+every entry seen, by entryUUID, are kept in SQLite: a restart resumes where
+the last run left off, the server only sending what changed since, and
+deletions, which syncrepl reports by UUID alone, are reported by DN.
+Changes are reported at least once; those made while the state was being
+saved may be reported again after a crash.
+'''
+import os
+import json
+import errno
+import sqlite3
+import hashlib
+from base64 import b64encode
+
+# Needs pyasn1
+from ldap.syncrepl import SyncreplConsumer
+
+import ldapvi
+import ldapcache
+
+# Bumped whenever the schema changes; states of other versions are started
+# over.
+FORMAT = 1
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+CREATE TABLE IF NOT EXISTS uuids (uuid TEXT PRIMARY KEY, dn TEXT);
+'''
+
+
+def state_path(uri, binddn, base, scope, filterstr):
+    '''
+    Return where to keep the state of watching a search.
+    '''
+    key = uri, binddn, base, scope, filterstr
+    return os.path.join(ldapcache.cache_dir(), 'watch-%s.sqlite' %
+                        hashlib.sha1(repr(key)).hexdigest())
+
+
+class LDIFEvents(object):
+    '''
+    Write changes to stream as LDIF: the new content of entries added,
+    modified or renamed, after a comment telling which, and delete change
+    records.
+    '''
+    def __init__(self, stream):
+        self.stream = stream
+        self.writer = ldapvi.LDIFWriter(stream)
+
+    def entry(self, event, dn, entry, uuid, old_dn=None):
+        if old_dn:
+            event += ' from %s' % old_dn
+        self.stream.write('# %s\n' % event)
+        self.writer.unparse(dn, entry)
+        self.stream.flush()
+
+    def delete(self, dn, uuid):
+        self.stream.write('# delete\n')
+        self.writer._unparseAttrTypeandValue('dn', dn)
+        self.writer._unparseAttrTypeandValue('changetype', 'delete')
+        self.stream.write(self.writer.line_sep)
+        self.stream.flush()
+
+
+class JSONEvents(object):
+    '''
+    Write changes to stream as JSON Lines: objects with event ('add',
+    'modify', 'rename' or 'delete'), dn, uuid, entry unless deleted and
+    old_dn if renamed. Attributes with values that are not UTF-8 have ':'
+    appended to their names and their values base64-encoded, like in LDIF.
+    '''
+    def __init__(self, stream):
+        self.stream = stream
+
+    def _write(self, obj):
+        self.stream.write(json.dumps(obj, sort_keys=True) + '\n')
+        self.stream.flush()
+
+    def entry(self, event, dn, entry, uuid, old_dn=None):
+        attrs = {}
+        for attr, values in entry.items():
+            if all(ldapvi._is_utf8(v) for v in values):
+                attrs[attr] = values
+            else:
+                attrs[attr + ':'] = [b64encode(v) for v in values]
+        obj = {'event': event, 'dn': dn, 'uuid': uuid, 'entry': attrs}
+        if old_dn:
+            obj['old_dn'] = old_dn
+        self._write(obj)
+
+    def delete(self, dn, uuid):
+        self._write({'event': 'delete', 'dn': dn, 'uuid': uuid})
+
+
+FORMATS = {'ldif': LDIFEvents, 'json': JSONEvents}
+
+
+class Consumer(SyncreplConsumer):
+    '''
+    Report the changes found by syncrepl searches to events, see
+    LDIFEvents, keeping the state at path.
+
+    Without a cookie, the server starts by sending every entry; those are
+    only reported if initial is true.
+    '''
+    def __init__(self, path, events, initial=False):
+        dirname = os.path.dirname(path)
+        try:
+            os.makedirs(dirname, 0700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        self.db = sqlite3.connect(path)
+        self.db.text_factory = str
+        self.db.executescript(_SCHEMA)
+        if self._meta('format') != FORMAT:
+            self.db.execute('DELETE FROM meta')
+            self.db.execute('DELETE FROM uuids')
+            self.db.execute('INSERT INTO meta VALUES (?, ?)',
+                            ('format', FORMAT))
+            self.db.commit()
+        self.events = events
+        self.quiet = self.syncrepl_get_cookie() is None and not initial
+        # UUIDs of the entries found present while refreshing
+        self.present = set()
+        self.conn = None
+
+    def _meta(self, key):
+        row = self.db.execute('SELECT value FROM meta WHERE key = ?',
+                              (key,)).fetchone()
+        return row and row[0]
+
+    def _dn(self, uuid):
+        row = self.db.execute('SELECT dn FROM uuids WHERE uuid = ?',
+                              (uuid,)).fetchone()
+        return row and row[0]
+
+    # SyncreplConsumer issues its requests through these
+    def search_ext(self, *args, **kw):
+        return self.conn.search_ext(*args, **kw)
+
+    def result4(self, *args, **kw):
+        return self.conn.result4(*args, **kw)
+
+    def watch(self, conn, base, scope, filterstr, attrlist=None):
+        '''
+        Watch the search over conn until the server ends it.
+        '''
+        self.conn = conn
+        self.present = set()
+        msgid = self.syncrepl_search(base, scope, mode='refreshAndPersist',
+                                     filterstr=filterstr, attrlist=attrlist)
+        while self.syncrepl_poll(msgid=msgid, all=1):
+            pass
+
+    def syncrepl_get_cookie(self):
+        return self._meta('cookie')
+
+    def syncrepl_set_cookie(self, cookie):
+        # Along with the changes it covers
+        self.db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                        ('cookie', cookie))
+        self.db.commit()
+
+    def syncrepl_entry(self, dn, attrs, uuid):
+        old_dn = self._dn(uuid)
+        self.present.add(uuid)
+        self.db.execute('INSERT OR REPLACE INTO uuids VALUES (?, ?)',
+                        (uuid, dn))
+        if self.quiet:
+            return
+        if old_dn is None:
+            self.events.entry('add', dn, attrs, uuid)
+        elif ldapvi.dn_key(old_dn) != ldapvi.dn_key(dn):
+            self.events.entry('rename', dn, attrs, uuid, old_dn)
+        else:
+            self.events.entry('modify', dn, attrs, uuid)
+
+    def syncrepl_delete(self, uuids):
+        for uuid in uuids:
+            dn = self._dn(uuid)
+            if dn is None:
+                continue
+            self.db.execute('DELETE FROM uuids WHERE uuid = ?', (uuid,))
+            if not self.quiet:
+                self.events.delete(dn, uuid)
+
+    def syncrepl_present(self, uuids, refreshDeletes=False):
+        if uuids is not None:
+            self.present.update(uuids)
+            return
+        # The end of the present phase: entries not found present are gone
+        if not refreshDeletes:
+            self.syncrepl_delete([
+                uuid for uuid, in self.db.execute('SELECT uuid FROM uuids')
+                if uuid not in self.present])
+        self.present = set()
+
+    def syncrepl_refreshdone(self):
+        self.quiet = False
+        self.present = set()
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()